@@ -2,30 +2,35 @@
 This module contains the main logic of the Friend App application.
 """
 
-import secrets
-from flask import Flask, abort, redirect, render_template, request, session, make_response, flash
+import json
+import sqlite3
+import time
+from flask import Flask, abort, redirect, render_template, request, session, send_file, flash
+from flask import Response, jsonify, stream_with_context
 
 import config
+import db
+import events
+import images
+import jobs
+import loaders
 import messages
+import metrics
+import pagecache
+import passwords
+import recommend
+import sessions
 import users
 import threads
 
 app = Flask(__name__)
 app.secret_key = config.secret_key
-
-
-@app.before_request
-def ensure_csrf_token():
-    """Ensures that a CSRF token exists in the session."""
-    if "csrf_token" not in session:
-        session["csrf_token"] = secrets.token_hex(16)
-
-
-def check_csrf():
-    """Checks the CSRF token."""
-    if request.method == "POST":
-        if request.form.get("csrf_token") != session.get("csrf_token"):
-            abort(403)
+app.config["USE_X_SENDFILE"] = config.use_x_sendfile
+db.init_app(app)
+metrics.init_app(app)
+sessions.init_app(app)
+passwords.init_app(app)
+jobs.init_app(app)
 
 
 def require_login():
@@ -34,34 +39,109 @@ def require_login():
         abort(403)
 
 
+def parse_classes(entries):
+    """
+    Parses "title:value" class selections from a form. Returns None if any
+    of them is not a known class.
+    """
+    all_classes = messages.get_all_classes()
+    classes_selected = []
+    for entry in entries:
+        if entry:
+            class_title, _, class_value = entry.partition(":")
+            if class_title not in all_classes or class_value not in all_classes[class_title]:
+                return None
+            classes_selected.append((class_title, class_value))
+    return classes_selected
+
+
 @app.route("/")
 def index():
-    """Displays the homepage messages and unread messages for logged-in users."""
+    """
+    Displays the homepage messages and unread messages for logged-in users.
+    Anonymous visitors get the whole page from the page cache.
+    """
     user_id = session.get("user_id")
+    before_id = request.args.get("before", type=int)
+    after_id = request.args.get("after", type=int)
+    if not user_id:
+        return pagecache.page(lambda: render_index(None, before_id, after_id), before_id, after_id)
+    return render_index(user_id, before_id, after_id)
+
+
+def render_index(user_id, before_id, after_id):
+    """Renders the homepage around the cached list of messages."""
+    message_list = pagecache.fragment(
+        "messages", lambda: render_message_list(before_id, after_id), before_id, after_id
+    )
+    if message_list is None:
+        return redirect("/")
+
     unread_msgs = threads.get_unread_messages(user_id) if user_id else []
-    all_messages = messages.get_messages()
     return render_template(
-        "index.html", messages=all_messages, unread_msgs=unread_msgs
+        "index.html",
+        message_list=message_list,
+        unread_msgs=unread_msgs,
+        suggested=suggested_messages(user_id)
+    )
+
+
+def suggested_messages(user_id):
+    """Returns the ads suggested to a logged-in user, best first."""
+    if not user_id:
+        return []
+    viewer = loaders.load("users", user_id)
+    if not viewer:
+        return []
+    message_ids = recommend.suggestions(user_id, viewer["age"])
+    return [message for message in loaders.load_many("messages", message_ids) if message]
+
+
+def render_message_list(before_id, after_id):
+    """Renders one page of the homepage messages, or None if a cursor page is empty."""
+    page = messages.get_messages(before_id, after_id)
+    if not page["messages"] and (before_id or after_id):
+        return None
+    return render_template(
+        "_message_list.html",
+        messages=page["messages"],
+        older=page["older"],
+        newer=page["newer"]
     )
 
 
 @app.route("/user/<int:user_id>")
 def show_user(user_id):
-    """Displays the user's profile and messages."""
+    """
+    Displays the user's profile and messages. Anonymous visitors get the
+    whole page from the page cache.
+    """
+    if not session.get("user_id"):
+        return pagecache.page(lambda: render_user(user_id), request.args.get("from", "/"))
+    return render_user(user_id)
+
+
+def render_user(user_id):
+    """Renders a profile page around the cached list of the user's messages."""
     user = users.get_user(user_id)
     if not user:
         abort(404)
 
-    user_messages = users.get_messages(user_id)
-    image = users.get_image(user_id)
-    has_image = image is not None
-    
+    message_list = pagecache.fragment(
+        "user_messages",
+        lambda: render_template("_user_messages.html", messages=users.get_messages(user_id)),
+        user_id
+    )
+    has_image = user["image_hash"] is not None
+    own_profile = session.get("user_id") == user_id
+
     back_to = request.args.get("from", "/")
     return render_template(
         "show_user.html",
         user=user,
         has_image=has_image,
-        messages=user_messages,
+        message_list=message_list,
+        suggested=suggested_messages(user_id) if own_profile else [],
         previous_page=back_to
     )
 
@@ -73,29 +153,51 @@ def add_image():
     if request.method == "GET":
         return render_template("add_image.html")
 
-    check_csrf()
     file = request.files["image"]
-    if not file.filename.endswith(".jpg"):
-        return "ERROR: wrong file format"
-
     image = file.read()
     if len(image) > 100 * 1024:
         return "ERROR: image too large"
 
     user_id = session["user_id"]
-    users.update_image(user_id, image)
+    if not users.update_image(user_id, image):
+        return "ERROR: wrong file format"
     return redirect(f"/user/{user_id}")
 
 
 @app.route("/image/<int:user_id>")
 def show_image(user_id):
-    """Displays the user's profile image."""
-    image = users.get_image(user_id)
-    if not image:
+    """
+    Displays the user's profile image, or a precomputed thumbnail with
+    ?size=64 or ?size=256. WebP is served to clients that accept it. The
+    content hash is a strong ETag; URLs carrying the current hash as ?v= may
+    be cached forever, except while the requested thumbnail is still being
+    made and the original is served in its place.
+    """
+    user = users.get_user(user_id)
+    if not user or not user["image_hash"]:
         abort(404)
 
-    response = make_response(bytes(image))
-    response.headers.set("Content-Type", "image/jpeg")
+    image_hash = user["image_hash"]
+    size = request.args.get("size", type=int)
+    accept_webp = "image/webp" in request.headers.get("Accept", "")
+    variant, mimetype = images.choose_variant(image_hash, size, accept_webp)
+    response = send_file(
+        images.get_store().path(image_hash, variant),
+        mimetype=mimetype,
+        etag=f"{image_hash}.{variant}" if variant else image_hash,
+        conditional=True,
+    )
+    response.vary.add("Accept")
+    if response.status_code == 200:
+        metrics.IMAGE_BYTES.inc(response.content_length or 0, variant=variant or "original")
+    fallback = size in images.THUMBNAIL_SIZES and variant is None
+    if request.args.get("v") == image_hash and not fallback:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
     return response
 
 
@@ -111,7 +213,6 @@ def edit_profile():
     if request.method == "GET":
         return render_template("edit_profile.html", user=user)
 
-    check_csrf()
     age = request.form.get("age")
     bio = request.form.get("bio")
     if not age or not bio:
@@ -126,17 +227,14 @@ def edit_profile():
 
     file = request.files.get("image")
     if file and file.filename != "":
-        if file.filename.lower().endswith((".jpg", ".jpeg")):
-            image = file.read()
-            if len(image) <= 100 * 1024:
-                users.update_image(user_id, image)
-                flash("Profiilikuva päivitetty!")
-            else:
-                flash("Profiilikuva on liian suuri (max 100kb).")
-                return redirect("/edit_profile")
-        else:
-            flash("Väärä tiedostomuoto, käytä .jpg tai .jpeg")
+        image = file.read()
+        if len(image) > 100 * 1024:
+            flash("Profiilikuva on liian suuri (max 100kb).")
             return redirect("/edit_profile")
+        if not users.update_image(user_id, image):
+            flash("Väärä tiedostomuoto, käytä jpg-, png- tai webp-kuvaa")
+            return redirect("/edit_profile")
+        flash("Profiilikuva päivitetty!")
 
     users.update_profile(user_id, age, bio)
     flash("Profiili päivitetty onnistuneesti!")
@@ -146,23 +244,74 @@ def edit_profile():
 @app.route("/find_message")
 def find_message():
     """Searches messages by a query string."""
-    query = request.args.get("query")
-    results = messages.find_messages(query) if query else []
-    return render_template("find_message.html", query=query or "", results=results)
+    query = request.args.get("query", "")
+    page = max(request.args.get("page", 1, type=int), 1)
+    classes_selected = parse_classes(request.args.getlist("classes")) or []
+
+    found = {"results": [], "has_more": False}
+    if query:
+        found = messages.find_messages(query, classes_selected, page)
+
+    return render_template(
+        "find_message.html",
+        query=query,
+        classes=messages.get_all_classes(),
+        classes_selected=[f"{title}:{value}" for title, value in classes_selected],
+        results=found["results"],
+        page=page,
+        has_more=found["has_more"]
+    )
+
+
+@app.route("/browse")
+def browse():
+    """
+    Lists the ads that carry the selected classes (?class_id=) and whose age
+    is within ?min_age= and ?max_age=, with the number of ads per class.
+    Returns JSON to clients that prefer application/json.
+    """
+    known_ids = {row["id"] for row in messages.get_class_list()}
+    class_ids = [i for i in request.args.getlist("class_id", type=int) if i in known_ids]
+    min_age = request.args.get("min_age", type=int)
+    max_age = request.args.get("max_age", type=int)
+    before_id = request.args.get("before", type=int)
+    page = messages.browse(class_ids, min_age, max_age, before_id)
+    facets = messages.get_facets()
+
+    best = request.accept_mimetypes.best_match(["text/html", "application/json"])
+    if best == "application/json":
+        return jsonify(
+            messages=[
+                {"id": row["id"], "title": row["title"], "username": row["username"],
+                 "user_age": row["user_age"]}
+                for row in page["messages"]
+            ],
+            older=page["older"],
+            facets={
+                title: [{"id": row["id"], "value": row["value"], "count": row["message_count"]}
+                        for row in rows]
+                for title, rows in facets.items()
+            }
+        )
+
+    return render_template(
+        "browse.html",
+        messages=page["messages"],
+        older=page["older"],
+        facets=facets,
+        class_ids=class_ids,
+        min_age=min_age,
+        max_age=max_age
+    )
 
 
 @app.route("/message/<int:message_id>")
 def show_message(message_id):
     """Displays a single message and its related threads."""
-    message = messages.get_message(message_id)
+    message = loaders.load("messages", message_id)
     if not message:
         abort(404)
 
-    user = users.get_user(message["user_id"])
-    if not user:
-        abort(404)
-
-    classes_list = messages.get_classes(message_id)
     user_id = session.get("user_id")
     threads_list = (
         threads.get_threads_by_message(message_id)
@@ -173,9 +322,8 @@ def show_message(message_id):
     return render_template(
         "show_message.html",
         message=message,
-        classes=classes_list,
-        threads=threads_list,
-        user=user
+        classes=message["classes"],
+        threads=threads_list
     )
 
 
@@ -191,7 +339,6 @@ def new_message():
 def create_message():
     """Creates a new message."""
     require_login()
-    check_csrf()
 
     title = request.form["title"]
     description = request.form["description"]
@@ -205,15 +352,9 @@ def create_message():
         abort(403)
     age = user["age"]
 
-    all_classes = messages.get_all_classes()
-    classes_selected = []
-
-    for entry in request.form.getlist("classes"):
-        if entry:
-            class_title, class_value = entry.split(":")
-            if class_title not in all_classes or class_value not in all_classes[class_title]:
-                abort(403)
-            classes_selected.append((class_title, class_value))
+    classes_selected = parse_classes(request.form.getlist("classes"))
+    if classes_selected is None:
+        abort(403)
 
     messages.add_message(title, description, age, user_id, classes_selected)
     return redirect("/")
@@ -244,9 +385,8 @@ def edit_message(message_id):
 def update_message():
     """Updates an existing message."""
     require_login()
-    check_csrf()
 
-    message_id = request.form["message_id"]
+    message_id = request.form.get("message_id", type=int)
     message = messages.get_message(message_id)
     if not message or message["user_id"] != session["user_id"]:
         abort(403)
@@ -256,15 +396,9 @@ def update_message():
     if not title or len(title) > 50 or not description or len(description) > 1000:
         abort(403)
 
-    all_classes = messages.get_all_classes()
-    classes_selected = []
-
-    for entry in request.form.getlist("classes"):
-        if entry:
-            class_title, class_value = entry.split(":")
-            if class_title not in all_classes or class_value not in all_classes[class_title]:
-                abort(403)
-            classes_selected.append((class_title, class_value))
+    classes_selected = parse_classes(request.form.getlist("classes"))
+    if classes_selected is None:
+        abort(403)
 
     user_id = session["user_id"]
     messages.update_message(message_id, user_id, title, description, classes_selected)
@@ -283,13 +417,13 @@ def remove_message(message_id):
     if request.method == "GET":
         return render_template("remove_message.html", message=message)
 
-    check_csrf()
 
     if "back" in request.form:
         return redirect(f"/message/{message_id}")
 
     if "remove" in request.form:
         messages.remove_message(message_id, user_id)
+        jobs.enqueue("purge_message", message_id, key=f"purge_message:{message_id}")
         return redirect("/")
 
     return redirect(f"/message/{message_id}")
@@ -304,7 +438,6 @@ def register():
 @app.route("/create", methods=["POST"])
 def create():
     """Creates a new user with required age, bio, and optional profile image."""
-    check_csrf()
 
     username = request.form.get("username")
     password1 = request.form.get("password1")
@@ -328,23 +461,24 @@ def create():
 
     bio = bio.strip()
 
+    if not passwords.attempts_by_address.hit(request.remote_addr):
+        abort(429)
     try:
         user_id = users.create_user(username, password1, age, bio)
-    except Exception:
+    except sqlite3.IntegrityError:
         flash("Käyttäjänimi on jo käytössä.")
         return redirect("/register")
 
     file = request.files.get("image")
-    if file and file.filename.endswith(".jpg"):
+    if file and file.filename != "":
         image = file.read()
-        if len(image) <= 100 * 1024:
-            users.update_image(user_id, image)
-        else:
+        if len(image) > 100 * 1024:
             flash("Profiilikuva on liian suuri (max 100kb).")
+        elif not users.update_image(user_id, image):
+            flash("Väärä tiedostomuoto, käytä jpg-, png- tai webp-kuvaa")
 
     session["user_id"] = user_id
     session["username"] = username
-    session["csrf_token"] = secrets.token_hex(16)
 
     return redirect(f"/user/{user_id}")
 
@@ -355,16 +489,20 @@ def login():
     if request.method == "GET":
         return render_template("login.html")
 
-    check_csrf()
     username = request.form["username"]
     password = request.form["password"]
+    if not passwords.attempts_by_address.hit(request.remote_addr):
+        abort(429)
+    if not passwords.failures_by_username.allowed(username):
+        abort(429)
     user_id = users.check_login(username, password)
 
     if user_id:
+        passwords.failures_by_username.reset(username)
         session["user_id"] = user_id
         session["username"] = username
-        session["csrf_token"] = secrets.token_hex(16)
         return redirect("/")
+    passwords.failures_by_username.add(username)
     return "ERROR: invalid username or password"
 
 
@@ -394,31 +532,107 @@ def start_thread(message_id):
 
 @app.route("/thread/<int:thread_id>")
 def show_thread(thread_id):
-    """Displays the messages of a thread and marks them as read."""
+    """
+    Displays the latest messages of a thread, or the page before ?before=,
+    and marks the thread as read.
+    """
     require_login()
     user_id = session["user_id"]
     thread_info = threads.get_thread(thread_id)
     if not thread_info:
         abort(404)
 
-    threads.mark_thread_as_read(thread_id, user_id)
-    msgs = threads.get_messages(thread_id, user_id)
-    message_id = thread_info["ad_id"]
+    before_id = request.args.get("before", type=int)
+    page = threads.get_messages(thread_id, before_id=before_id)
+    if page["messages"]:
+        threads.mark_thread_as_read(thread_id, user_id, page["messages"][-1]["id"])
+    return render_thread(thread_info, thread_id, user_id, page, before_id)
+
 
+def render_thread(thread_info, thread_id, user_id, page, before_id):
+    """Renders a page of thread messages; the latest page is live."""
     return render_template(
         "thread.html",
-        messages=msgs,
+        messages=page["messages"],
+        earlier=page["earlier"],
+        live=before_id is None,
         thread_id=thread_id,
         user_id=user_id,
-        message_id=message_id
+        message_id=thread_info["ad_id"]
     )
 
 
+def message_data(msg):
+    """Returns a thread message as a JSON-serialisable dict."""
+    return {
+        "id": msg["id"],
+        "sender_id": msg["sender_id"],
+        "sender_name": msg["sender_name"],
+        "content": msg["content"],
+        "created_at": str(msg["created_at"]),
+    }
+
+
+def events_after(thread_info, user_id):
+    """
+    Returns the id after which a thread events request wants messages, from
+    the Last-Event-ID header or ?after=. Answers 404 unless the user takes
+    part in the thread.
+    """
+    if not thread_info or user_id not in (thread_info["user1_id"], thread_info["user2_id"]):
+        abort(404)
+    after_id = request.headers.get("Last-Event-ID", type=int)
+    if after_id is None:
+        after_id = request.args.get("after", 0, type=int)
+    return after_id
+
+
+@app.route("/thread/<int:thread_id>/events")
+def thread_events(thread_id):
+    """
+    Pushes messages newer than ?after= (or the Last-Event-ID header) as
+    Server-Sent Events. Clients that do not accept text/event-stream get a
+    long-poll JSON response instead. The database connection is returned to
+    the pool while waiting, so idle streams only hold a (green) thread.
+    """
+    require_login()
+    user_id = session["user_id"]
+    after_id = events_after(threads.get_thread(thread_id), user_id)
+
+    if "text/event-stream" not in request.headers.get("Accept", ""):
+        msgs = threads.get_messages(thread_id, after_id=after_id)["messages"]
+        if not msgs:
+            db.close_connection()
+            events.wait(thread_id, after_id, config.long_poll_timeout)
+            msgs = threads.get_messages(thread_id, after_id=after_id)["messages"]
+        if msgs:
+            threads.mark_thread_as_read(thread_id, user_id, msgs[-1]["id"])
+        return jsonify(messages=[message_data(msg) for msg in msgs])
+
+    def stream(after_id):
+        deadline = time.monotonic() + config.stream_timeout
+        while time.monotonic() < deadline:
+            msgs = threads.get_messages(thread_id, after_id=after_id)["messages"]
+            if msgs:
+                threads.mark_thread_as_read(thread_id, user_id, msgs[-1]["id"])
+            db.close_connection()
+            for msg in msgs:
+                after_id = msg["id"]
+                yield f"id: {after_id}\ndata: {json.dumps(message_data(msg))}\n\n"
+            timeout = min(15, deadline - time.monotonic())
+            if not msgs and not events.wait(thread_id, after_id, max(timeout, 0)):
+                yield ": keep-alive\n\n"
+
+    response = Response(stream_with_context(stream(after_id)), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @app.route("/send_message", methods=["POST"])
 def send_message():
     """Sends a message in a thread."""
     require_login()
-    check_csrf()
     thread_id = request.form["thread_id"]
     content = request.form["content"]
     if not content.strip():
@@ -430,11 +644,14 @@ def send_message():
 
 @app.route("/threads")
 def user_threads():
-    """Displays all threads of the logged-in user."""
+    """Displays the logged-in user's threads, most recently active first."""
     require_login()
     user_id = session["user_id"]
-    thread_list = threads.get_user_threads(user_id)
-    return render_template("threads.html", threads=thread_list)
+    before = request.args.get("before")
+    before_id = request.args.get("before_id", type=int)
+    cursor = (before, before_id) if before and before_id is not None else None
+    page = threads.get_user_threads(user_id, cursor)
+    return render_template("threads.html", threads=page["threads"], older=page["older"])
 
 
 
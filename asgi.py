@@ -0,0 +1,273 @@
+"""
+ASGI entry point of the Friend App.
+
+The thread page and the thread event stream are served by async views that
+await their queries on the database threads of db.run_async, so one event
+loop keeps many requests in flight while SQLite works. An open event stream
+waits on an asyncio future and holds no thread. The views use the same query
+functions, templates and request hooks as the views in app.py. The homepage
+runs the view of app.py itself on a database thread. Every other route is
+passed to the WSGI application through asgiref, each request on a thread of
+the executor.
+
+Usage:
+    uvicorn asgi:application --workers 4
+"""
+
+import asyncio
+import io
+import json
+import sys
+import time
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import abort, copy_current_request_context, jsonify, request, session
+from werkzeug.exceptions import HTTPException
+
+import config
+import db
+import events
+import threads
+from app import app, events_after, message_data, render_thread, require_login
+
+
+class EventStream:
+    """The result of a streaming view: an async iterator of body chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+
+async def index():
+    """
+    Runs the index view of app.py on a database thread, in a copy of the
+    request context, so that the homepage keeps its page cache, ETags and
+    suggestions. Its queries use the thread's connection and are added to
+    the profile of the request.
+    """
+    view = app.view_functions["index"]
+
+    @copy_current_request_context
+    def run_view():
+        with db.thread_context():
+            return view()
+    return await db.run_async(run_view)
+
+
+async def show_thread(thread_id):
+    """Async variant of app.show_thread."""
+    require_login()
+    user_id = session["user_id"]
+    thread_info = await db.run_async(threads.get_thread, thread_id)
+    if not thread_info:
+        abort(404)
+
+    before_id = request.args.get("before", type=int)
+    page = await db.run_async(threads.get_messages, thread_id, before_id)
+    if page["messages"]:
+        last_id = page["messages"][-1]["id"]
+        await db.run_async(threads.mark_thread_as_read, thread_id, user_id, last_id)
+    return render_thread(thread_info, thread_id, user_id, page, before_id)
+
+
+async def thread_events(thread_id):
+    """Async variant of app.thread_events."""
+    require_login()
+    user_id = session["user_id"]
+    after_id = events_after(await db.run_async(threads.get_thread, thread_id), user_id)
+
+    if "text/event-stream" not in request.headers.get("Accept", ""):
+        msgs = await new_messages(thread_id, user_id, after_id)
+        if not msgs:
+            await events.wait_async(thread_id, after_id, config.long_poll_timeout)
+            msgs = await new_messages(thread_id, user_id, after_id)
+        return jsonify(messages=[message_data(msg) for msg in msgs])
+    return EventStream(event_stream(thread_id, user_id, after_id))
+
+
+async def new_messages(thread_id, user_id, after_id):
+    """Returns the messages newer than after_id and marks them read."""
+    page = await db.run_async(threads.get_messages, thread_id, None, after_id)
+    if page["messages"]:
+        last_id = page["messages"][-1]["id"]
+        await db.run_async(threads.mark_thread_as_read, thread_id, user_id, last_id)
+    return page["messages"]
+
+
+async def event_stream(thread_id, user_id, after_id):
+    """Yields new thread messages as Server-Sent Events until STREAM_TIMEOUT."""
+    deadline = time.monotonic() + config.stream_timeout
+    while time.monotonic() < deadline:
+        msgs = await new_messages(thread_id, user_id, after_id)
+        for msg in msgs:
+            after_id = msg["id"]
+            yield f"id: {after_id}\ndata: {json.dumps(message_data(msg))}\n\n".encode()
+        timeout = min(15, deadline - time.monotonic())
+        if not msgs and not await events.wait_async(thread_id, after_id, max(timeout, 0)):
+            yield b": keep-alive\n\n"
+
+
+ASYNC_VIEWS = {
+    "index": index,
+    "show_thread": show_thread,
+    "thread_events": thread_events,
+}
+
+
+class ThreadPoolWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """
+    Runs the WSGI application on the executor of the event loop. The asgiref
+    default runs every request on one shared thread, where a single slow
+    request would hold up all the others.
+    """
+
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False
+    )
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi with each request on a thread of its own."""
+
+    async def __call__(self, scope, receive, send):
+        instance = ThreadPoolWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)
+        await instance(scope, receive, send)
+
+
+wsgi_application = ThreadPoolWsgiToAsgi(app)
+
+
+def build_environ(scope):
+    """Builds the WSGI environ of a body-less ASGI HTTP request."""
+    script_name = scope.get("root_path", "")
+    path_info = scope["path"]
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path_info.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+def async_endpoint(environ):
+    """Returns the async view for the request, or None to use the WSGI app."""
+    if environ["REQUEST_METHOD"] != "GET":
+        return None
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return None
+    return ASYNC_VIEWS.get(endpoint)
+
+
+async def dispatch(view, environ):
+    """Runs an async view with the same request hooks as Flask.wsgi_app."""
+    ctx = app.request_context(environ)
+    error = None
+    try:
+        try:
+            ctx.push()
+            try:
+                response = app.preprocess_request()
+                if response is None:
+                    response = await view(**request.view_args)
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                response = app.handle_user_exception(exception)
+            if isinstance(response, EventStream):
+                stream, response = response, app.response_class(mimetype="text/event-stream")
+                response.headers["Cache-Control"] = "no-cache"
+                response.headers["X-Accel-Buffering"] = "no"
+            else:
+                stream = None
+            response = app.finalize_request(response)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            error = exception
+            response = app.handle_exception(exception)
+            stream = None
+        body = stream.chunks if stream else response.get_data()
+        return response.status_code, list(response.headers.items()), body
+    finally:
+        ctx.pop(error)
+
+
+async def lifespan(receive, send):
+    """Acknowledges the server's startup and shutdown events."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    environ = build_environ(scope)
+    view = async_endpoint(environ)
+    if view is None:
+        await wsgi_application(scope, receive, send)
+        return
+
+    status, headers, body = await dispatch(view, environ)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers],
+    })
+    if isinstance(body, bytes):
+        await send({"type": "http.response.body", "body": body})
+    else:
+        await send_stream(body, receive, send)
+
+
+async def send_stream(chunks, receive, send):
+    """Sends the chunks of a streaming response until they end or the client leaves."""
+    async def pump():
+        async for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    sender = asyncio.ensure_future(pump())
+    watcher = asyncio.ensure_future(disconnected())
+    await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+    for task in (sender, watcher):
+        task.cancel()
+    try:
+        await sender
+    except asyncio.CancelledError:
+        pass
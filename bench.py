@@ -0,0 +1,174 @@
+"""
+Benchmark the hot routes of the Friend App with the Flask test client.
+
+Run seed.py first. Each route is requested --requests times as a logged-in
+user; latency percentiles and SQL statements per request are printed and
+saved as JSON. With --baseline the run is compared to an earlier result and
+routes that got slower than --threshold are reported as regressions.
+
+Usage:
+    python bench.py --output bench_results.json
+    python bench.py --baseline bench_results.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import re
+import statistics
+import sys
+import time
+
+import app as friend_app
+import cache
+import config
+import db
+
+SERVER_TIMING = re.compile(r'db;desc="(\d+) statements"')
+
+
+def percentile(values, fraction):
+    """Return the given percentile (0..1) of a list of numbers."""
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def statement_count(response):
+    """Return the statement count from the Server-Timing header added by db.py."""
+    match = SERVER_TIMING.search(response.headers.get("Server-Timing", ""))
+    return int(match.group(1)) if match else 0
+
+
+def sample_routes(rng):
+    """Pick existing ids from the database and return (name, url, user_id) triples."""
+    with friend_app.app.app_context():
+        thread = db.query("SELECT id, user1_id FROM threads ORDER BY random() LIMIT 1")
+        message = db.query("SELECT id FROM messages ORDER BY random() LIMIT 1")
+        middle = db.query("SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET 200")
+    if not thread or not message:
+        sys.exit("The database is empty, run seed.py first.")
+
+    user_id = thread[0]["user1_id"]
+    older = middle[0]["id"] if middle else message[0]["id"]
+    word = rng.choice(["lenkillä", "elokuvista", "seuraa", "kahville", "retkeilen"])
+    return [
+        ("index", "/", user_id),
+        ("index_page", f"/?before={older}", user_id),
+        ("find_message", f"/find_message?query={word}", user_id),
+        ("show_message", f"/message/{message[0]['id']}", user_id),
+        ("show_thread", f"/thread/{thread[0]['id']}", user_id),
+        ("threads", "/threads", user_id),
+    ]
+
+
+def run(requests, warmup, rng):
+    """Request every route and return the per-route statistics."""
+    results = {}
+    for name, url, user_id in sample_routes(rng):
+        client = friend_app.app.test_client()
+        with client.session_transaction() as session:
+            session["user_id"] = user_id
+            session["username"] = f"user{user_id}"
+
+        for _ in range(warmup):
+            client.get(url)
+
+        latencies = []
+        statements = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = client.get(url)
+            latencies.append((time.perf_counter() - started) * 1000)
+            statements.append(statement_count(response))
+            if response.status_code >= 400:
+                sys.exit(f"{url} returned {response.status_code}")
+
+        results[name] = {
+            "url": url,
+            "requests": requests,
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p90_ms": round(percentile(latencies, 0.90), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "mean_ms": round(statistics.fmean(latencies), 3),
+            "max_ms": round(max(latencies), 3),
+            "queries_per_request": round(statistics.fmean(statements), 2),
+        }
+    return results
+
+
+def row_counts():
+    """Return the sizes of the main tables, stored with the results for context."""
+    with friend_app.app.app_context():
+        return {
+            table: db.query(f"SELECT COUNT(*) FROM {table}")[0][0]
+            for table in ["users", "messages", "threads", "thread_messages"]
+        }
+
+
+def compare(results, baseline, threshold):
+    """Print the change of p50 against a baseline run and return the regressions."""
+    regressions = []
+    for name, stats in results.items():
+        old = baseline["routes"].get(name)
+        if not old:
+            continue
+        ratio = stats["p50_ms"] / old["p50_ms"] if old["p50_ms"] else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<14} p50 {old['p50_ms']:>9.2f} -> {stats['p50_ms']:>9.2f} ms "
+              f"({ratio:5.2f}x)  queries {old['queries_per_request']} -> "
+              f"{stats['queries_per_request']}{flag}")
+    return regressions
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-cache", action="store_true", help="disable the read cache")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="compare against an earlier JSON result")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative p50 slowdown reported as a regression")
+    args = parser.parse_args()
+
+    if args.no_cache:
+        cache.disable()
+    config.profile_sample_rate = 1.0
+
+    results = run(args.requests, args.warmup, random.Random(args.seed))
+    print(f"{'route':<14} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}  queries")
+    for name, stats in results.items():
+        print(f"{name:<14} {stats['p50_ms']:>8.2f} {stats['p90_ms']:>8.2f} "
+              f"{stats['p99_ms']:>8.2f} {stats['max_ms']:>8.2f}  {stats['queries_per_request']}")
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cache": not args.no_cache,
+        "rows": row_counts(),
+        "routes": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+In-process read cache for rows that are read far more often than written.
+
+Each named cache is a bounded LRU with an optional time to live. Write paths
+invalidate the entries they change explicitly; the TTL bounds how stale a
+row can get in other worker processes.
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+MISSING = object()
+
+enabled = config.cache_enabled
+
+
+class LRUCache:
+    """A bounded, thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or MISSING."""
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is not MISSING:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entry when full."""
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """Remove a single entry if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return the size and hit/miss/eviction counters."""
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+caches = {}
+
+
+def cached(name, maxsize=1024, ttl=60):
+    """
+    Decorator caching a lookup function by its positional arguments.
+    None results are not cached, so rows created later are found at once.
+    """
+    store = caches.setdefault(name, LRUCache(maxsize, ttl))
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            if not enabled:
+                return func(*args)
+            value = store.get(args)
+            if value is MISSING:
+                value = func(*args)
+                if value is not None:
+                    store.set(args, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def get_many(name, keys):
+    """
+    Return {key: value} for the cached single-argument lookups of the given
+    keys, e.g. get_many("users", [1, 2]) for get_user(1) and get_user(2).
+    """
+    store = caches.get(name)
+    if not enabled or store is None:
+        return {}
+    found = {}
+    for key in keys:
+        value = store.get((key,))
+        if value is not MISSING:
+            found[key] = value
+    return found
+
+
+def set_many(name, values):
+    """Store {key: value} as the results of single-argument lookups."""
+    store = caches.get(name)
+    if not enabled or store is None:
+        return
+    for key, value in values.items():
+        store.set((key,), value)
+
+
+def invalidate(name, *key):
+    """Drop one cached lookup, identified by the arguments it was called with."""
+    if name in caches:
+        caches[name].delete(key)
+
+
+def clear(name=None):
+    """Drop every entry of one cache, or of all caches."""
+    for cache_name, store in caches.items():
+        if name is None or cache_name == name:
+            store.clear()
+
+
+def stats():
+    """Return the counters of every cache by name."""
+    return {name: store.stats() for name, store in caches.items()}
+
+
+def disable():
+    """Turn caching off and drop everything, e.g. for tests."""
+    global enabled  # pylint: disable=global-statement
+    enabled = False
+    clear()
+
+
+def enable():
+    """Turn caching back on."""
+    global enabled  # pylint: disable=global-statement
+    enabled = True
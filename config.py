@@ -3,3 +3,36 @@ import os
 secret_key = os.getenv("SECRET_KEY", "dev-secret")
 database_url = os.getenv("DATABASE_URL", "database.db")
 
+cache_enabled = os.getenv("CACHE_ENABLED", "1") != "0"
+image_store = os.getenv("IMAGE_STORE", "file")
+image_dir = os.getenv("IMAGE_DIR", "images")
+use_x_sendfile = os.getenv("USE_X_SENDFILE", "0") == "1"
+job_workers = int(os.getenv("JOB_WORKERS", "2"))
+stream_timeout = int(os.getenv("STREAM_TIMEOUT", "300"))
+long_poll_timeout = int(os.getenv("LONG_POLL_TIMEOUT", "25"))
+profile_sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", "0.1"))
+profile_top_n = int(os.getenv("PROFILE_TOP_N", "5"))
+n_plus_one_threshold = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+slow_query_ms = float(os.getenv("SLOW_QUERY_MS", "100"))
+metrics_dir = os.getenv("METRICS_DIR", "")
+metrics_flush_interval = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+metrics_token = os.getenv("METRICS_TOKEN", "")
+async_db_threads = int(os.getenv("ASYNC_DB_THREADS", "4"))
+write_batch_ms = float(os.getenv("WRITE_BATCH_MS", "2"))
+write_batch_size = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+write_synchronous = os.getenv("WRITE_SYNCHRONOUS", "NORMAL").upper()
+page_cache = os.getenv("PAGE_CACHE", "memory")
+page_cache_size = int(os.getenv("PAGE_CACHE_SIZE", "512"))
+session_store = os.getenv("SESSION_STORE", "cookie")
+csrf_token_ttl = int(os.getenv("CSRF_TOKEN_TTL", "86400"))
+password_method = os.getenv("PASSWORD_METHOD", "scrypt")
+password_workers = int(os.getenv("PASSWORD_WORKERS", "0"))
+password_queue_depth = int(os.getenv("PASSWORD_QUEUE_DEPTH", "32"))
+login_window = int(os.getenv("LOGIN_WINDOW", "300"))
+login_address_limit = int(os.getenv("LOGIN_ADDRESS_LIMIT", "50"))
+login_username_limit = int(os.getenv("LOGIN_USERNAME_LIMIT", "10"))
+recommend_ttl = int(os.getenv("RECOMMEND_TTL", "300"))
+recommend_rebuild_interval = int(os.getenv("RECOMMEND_REBUILD_INTERVAL", "60"))
+job_poll_interval = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+job_max_attempts = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+job_cleanup_interval = int(os.getenv("JOB_CLEANUP_INTERVAL", "3600"))
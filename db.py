@@ -2,41 +2,351 @@
 This module contains general functions related to database queries.
 """
 
+import asyncio
+import functools
+import heapq
+import json
+import logging
+import queue
+import random
+import re
 import sqlite3
-from flask import g
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import g, has_app_context, request
 
-def get_connection():
-    """Returns a new SQLite connection and enables foreign keys."""
-    con = sqlite3.connect("database.db")
+import config
+import metrics
+
+logger = logging.getLogger("friendapp.db")
+
+POOL_SIZE = 8
+POOL_TIMEOUT = 10
+
+PRAGMAS = (
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+def database_path():
+    """Returns the SQLite file path configured in config.database_url."""
+    url = config.database_url
+    if url.startswith("sqlite:///"):
+        return url[len("sqlite:///"):]
+    return url
+
+
+def connect(path=None):
+    """Opens a new SQLite connection and applies the connection pragmas once."""
+    con = sqlite3.connect(
+        path or database_path(), isolation_level=None, check_same_thread=False
+    )
     con.row_factory = sqlite3.Row
-    con.execute("PRAGMA foreign_keys = ON")
+    for pragma in PRAGMAS:
+        con.execute(pragma)
     return con
 
+
+class ConnectionPool:
+    """A bounded pool of SQLite connections shared by the worker threads."""
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """Returns an idle connection, opening a new one while below the limit."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError("database connection pool exhausted")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return connect(self.path)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, con):
+        """Returns a connection to the pool, rolling back any open transaction."""
+        try:
+            if con.in_transaction:
+                con.rollback()
+            self._idle.put(con)
+        except sqlite3.Error:
+            con.close()
+        finally:
+            self._slots.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_pool():
+    """Returns the connection pool for the configured database."""
+    path = database_path()
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
+
+
+def get_connection():
+    """
+    Returns the connection bound to the current request, or to the current
+    thread when used outside of a Flask app context (scripts, workers).
+    """
+    holder = g if has_app_context() else _local
+    con = getattr(holder, "db_connection", None)
+    if con is None:
+        con = get_pool().acquire()
+        holder.db_connection = con
+    return con
+
+
+def open_thread_connection():
+    """
+    Gives the current thread a connection of its own, opened outside the pool.
+    Long-lived threads (the writer, job workers and database threads) use it,
+    so that they never hold one of the POOL_SIZE connections that requests
+    share.
+    """
+    _local.db_connection = connect()
+    _local.dedicated = True
+
+
+def close_connection(exception=None):
+    """Releases the request or thread connection back to the pool."""
+    holder = g if has_app_context() else _local
+    con = getattr(holder, "db_connection", None)
+    if con is not None:
+        holder.db_connection = None
+        if holder is _local and getattr(_local, "dedicated", False):
+            _local.dedicated = False
+            con.close()
+        else:
+            get_pool().release(con)
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def normalize_sql(sql):
+    """Collapses whitespace and replaces literals, so that equal statements match."""
+    sql = _LITERALS.sub("?", " ".join(sql.split()))
+    return _IN_LISTS.sub("(?)", sql)
+
+
+class QueryProfile:
+    """Statement statistics of one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.rows = 0
+        self.statements = Counter()
+        self.slowest = []
+
+    def record(self, sql, elapsed, rows):
+        """Adds one executed statement."""
+        normalized = normalize_sql(sql)
+        self.count += 1
+        self.total_time += elapsed
+        self.rows += rows
+        self.statements[normalized] += 1
+        entry = (elapsed, self.count, normalized)
+        if len(self.slowest) < config.profile_top_n:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def repeated(self):
+        """Returns the statements repeated often enough to suggest an N+1 pattern."""
+        return [
+            {"sql": sql, "count": count}
+            for sql, count in self.statements.most_common()
+            if count > config.n_plus_one_threshold
+        ]
+
+    def summary(self):
+        """Returns the profile as a JSON-serialisable dict."""
+        return {
+            "statements": self.count,
+            "db_ms": round(self.total_time * 1000, 3),
+            "rows": self.rows,
+            "slowest": [
+                {"sql": sql, "ms": round(elapsed * 1000, 3)}
+                for elapsed, _, sql in sorted(self.slowest, reverse=True)
+            ],
+            "n_plus_one": self.repeated(),
+        }
+
+
+def _record(sql, started, rows):
+    """Times a statement, logs it when slow and adds it to the request profile."""
+    elapsed = time.perf_counter() - started
+    metrics.DB_STATEMENTS.inc()
+    metrics.DB_SECONDS.inc(elapsed)
+    if elapsed * 1000 >= config.slow_query_ms:
+        logger.warning("slow query %.1f ms: %s", elapsed * 1000, normalize_sql(sql))
+    if has_app_context():
+        profile = g.get("db_profile")
+    else:
+        profile = getattr(_local, "db_profile", None)
+    if profile is not None:
+        profile.record(sql, elapsed, rows)
+
+
+def start_profile():
+    """Starts profiling the statements of a sampled share of requests."""
+    if random.random() < config.profile_sample_rate:
+        g.db_profile = QueryProfile()
+
+
+def finish_profile(response):
+    """Adds a Server-Timing header and logs one structured line per profiled request."""
+    profile = g.pop("db_profile", None)
+    if profile is None:
+        return response
+
+    summary = profile.summary()
+    response.headers.add(
+        "Server-Timing", f'db;desc="{profile.count} statements";dur={summary["db_ms"]}'
+    )
+    line = {"path": request.path, "endpoint": request.endpoint,
+            "status": response.status_code, **summary}
+    level = logging.WARNING if summary["n_plus_one"] else logging.INFO
+    logger.log(level, json.dumps(line, ensure_ascii=False))
+    return response
+
+
+def init_app(app):
+    """Registers the connection teardown and query profiling with the application."""
+    app.teardown_appcontext(close_connection)
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+
+
+_async_executor = None
+_async_lock = threading.Lock()
+
+
+def _run_in_db_thread(profile, func, args):
+    _local.db_profile = profile
+    try:
+        return func(*args)
+    finally:
+        _local.db_profile = None
+
+
+async def run_async(func, *args):
+    """
+    Runs a synchronous query function, such as messages.get_messages, on one
+    of the dedicated database threads and awaits its result. Every database
+    thread keeps a connection of its own outside the pool, so the event loop
+    never blocks on SQLite. Statements are added to the profile of the calling request.
+    """
+    global _async_executor  # pylint: disable=global-statement
+    with _async_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(
+                max_workers=config.async_db_threads, thread_name_prefix="db",
+                initializer=open_thread_connection,
+            )
+    profile = g.get("db_profile") if has_app_context() else None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _async_executor, functools.partial(_run_in_db_thread, profile, func, args)
+    )
+
+
+@contextmanager
+def thread_context():
+    """
+    Lets an app context pushed on one of the database threads of run_async
+    use the thread's own connection and the profile of the calling request.
+    """
+    g.db_connection = _local.db_connection
+    g.db_profile = getattr(_local, "db_profile", None)
+    try:
+        yield
+    finally:
+        g.db_connection = None
+        g.pop("db_profile", None)
+
+
 def execute(sql, params=None):
     """Executes an SQL command and returns the ID of the last inserted row."""
     if params is None:
         params = []
     con = get_connection()
+    started = time.perf_counter()
+    cur = con.execute(sql, params)
+    _record(sql, started, max(cur.rowcount, 0))
+    if not con.in_transaction:
+        metrics.DB_COMMITS.inc()
+    if has_app_context():
+        g.last_insert_id = cur.lastrowid
+    return cur.lastrowid
+
+
+def execute_many(sql, seq_of_params):
+    """Executes an SQL command once for every parameter list in a single batch."""
+    con = get_connection()
+    with transaction():
+        started = time.perf_counter()
+        cur = con.executemany(sql, seq_of_params)
+        _record(sql, started, max(cur.rowcount, 0))
+
+
+@contextmanager
+def transaction():
+    """
+    Runs the enclosed statements as one unit of work with a single commit.
+    Nested blocks join the outer transaction.
+    """
+    con = get_connection()
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN IMMEDIATE")
     try:
-        cur = con.execute(sql, params)
+        yield con
         con.commit()
-        g.last_insert_id = cur.lastrowid 
-        return cur.lastrowid
-    finally:
-        con.close()
+    except BaseException:
+        # A failed commit (SQLITE_BUSY, disk full) leaves the transaction
+        # open, and later blocks on this connection would silently join it.
+        if con.in_transaction:
+            con.rollback()
+        raise
+    metrics.DB_COMMITS.inc()
+
 
 def query(sql, params=None):
     """Executes an SQL query and returns the results as a list."""
     if params is None:
         params = []
     con = get_connection()
-    try:
-        rows = con.execute(sql, params).fetchall()
-        return rows
-    finally:
-        con.close()
+    started = time.perf_counter()
+    rows = con.execute(sql, params).fetchall()
+    _record(sql, started, len(rows))
+    return rows
+
 
 def last_insert_id():
     """Returns the ID of the last inserted row from the Flask g object."""
     return getattr(g, "last_insert_id", None)
-
@@ -0,0 +1,81 @@
+"""
+In-process publish/subscribe for new thread messages.
+
+Publishing only wakes up the waiters of a thread; they read the new rows from
+the database themselves. A wakeup that is missed, for example because the
+message was sent through another worker process, is therefore picked up by
+the waiter's next timeout poll. The primitives are plain threading objects,
+so they become cooperative under gevent/eventlet monkey patching. Async views
+wait with wait_async(), which parks an asyncio future instead of a thread.
+"""
+
+import asyncio
+import threading
+
+_lock = threading.Lock()
+_channels = {}
+
+
+class _Channel:
+    """Latest message id of one thread and the condition its waiters sleep on."""
+
+    def __init__(self):
+        self.condition = threading.Condition(_lock)
+        self.latest_id = 0
+        self.waiters = 0
+        self.futures = set()
+
+
+def publish(thread_id, message_id):
+    """Wake up everyone waiting for messages in the thread."""
+    with _lock:
+        channel = _channels.get(thread_id)
+        if channel is not None:
+            channel.latest_id = max(channel.latest_id, message_id)
+            channel.condition.notify_all()
+            for loop, future in channel.futures:
+                loop.call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+def wait(thread_id, after_id, timeout):
+    """
+    Block until a message newer than after_id is published to the thread or
+    the timeout passes. Returns True if woken by a new message.
+    """
+    with _lock:
+        channel = _channels.setdefault(thread_id, _Channel())
+        channel.waiters += 1
+        try:
+            return channel.condition.wait_for(lambda: channel.latest_id > after_id, timeout)
+        finally:
+            channel.waiters -= 1
+            if channel.waiters == 0:
+                del _channels[thread_id]
+
+
+async def wait_async(thread_id, after_id, timeout):
+    """Like wait(), but awaits the wakeup on the running event loop."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    entry = (loop, future)
+    with _lock:
+        channel = _channels.setdefault(thread_id, _Channel())
+        if channel.latest_id > after_id:
+            return True
+        channel.waiters += 1
+        channel.futures.add(entry)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        with _lock:
+            channel.futures.discard(entry)
+            channel.waiters -= 1
+            if channel.waiters == 0:
+                del _channels[thread_id]
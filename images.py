@@ -0,0 +1,195 @@
+"""
+Content-addressed storage and processing for profile images.
+
+Images are stored once under the SHA-256 of their bytes; the users table only
+keeps the hash. The hash doubles as a strong ETag. When Pillow is installed,
+uploads are stripped of metadata and fixed-size JPEG and WebP thumbnails are
+generated by a background job; without it images are stored as-is.
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+
+import config
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - Pillow is optional
+    Image = None
+
+THUMBNAIL_SIZES = (64, 256)
+
+MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+PIL_FORMATS = {
+    "jpeg": "JPEG",
+    "png": "PNG",
+    "webp": "WEBP",
+}
+
+
+def detect_type(data):
+    """Return the image type from the magic bytes, or None if not supported."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class FileImageStore:
+    """Stores images in a directory tree keyed by their content hash."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, image_hash, variant=None):
+        """Return the file path of an image or of one of its variants."""
+        name = f"{image_hash}.{variant}" if variant else image_hash
+        return os.path.join(self.root, image_hash[:2], name)
+
+    def exists(self, image_hash, variant=None):
+        """Return True if the image (variant) is stored."""
+        return os.path.exists(self.path(image_hash, variant))
+
+    def read(self, image_hash, variant=None):
+        """Return the bytes of a stored image (variant)."""
+        with open(self.path(image_hash, variant), "rb") as file:
+            return file.read()
+
+    def put(self, data):
+        """Store image bytes and return their hash. Storing twice is a no-op."""
+        image_hash = hashlib.sha256(data).hexdigest()
+        if not self.exists(image_hash):
+            self._write(self.path(image_hash), data)
+        return image_hash
+
+    def put_variant(self, image_hash, variant, data):
+        """Store a derived variant, e.g. "64.webp", next to the original."""
+        self._write(self.path(image_hash, variant), data)
+
+    def delete(self, image_hash):
+        """Remove an image and its variants if they are stored."""
+        for variant in [None] + variant_names():
+            try:
+                os.remove(self.path(image_hash, variant))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+
+STORES = {
+    "file": FileImageStore,
+}
+
+_store = None
+
+
+def get_store():
+    """Return the image store selected by config.image_store."""
+    global _store  # pylint: disable=global-statement
+    if _store is None:
+        _store = STORES[config.image_store](config.image_dir)
+    return _store
+
+
+def variant_names():
+    """Return the names of all generated variants."""
+    names = ["webp"]
+    for size in THUMBNAIL_SIZES:
+        names += [f"{size}.jpeg", f"{size}.webp"]
+    return names
+
+
+def save_upload(data):
+    """
+    Validate an uploaded image by its magic bytes, strip its metadata and
+    store it. Returns the hash, or None if the data is not a supported
+    image. The thumbnails are made afterwards by ensure_variants().
+    """
+    image_type = detect_type(data)
+    if image_type is None:
+        return None
+
+    if Image is not None:
+        try:
+            data = _strip_metadata(data, image_type)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+
+    return get_store().put(data)
+
+
+def _strip_metadata(data, image_type):
+    """Re-encode the image without EXIF or other metadata, applying its rotation."""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        output = io.BytesIO()
+        if image_type == "jpeg":
+            image.convert("RGB").save(output, "JPEG", quality=90, optimize=True)
+        else:
+            image.save(output, PIL_FORMATS[image_type])
+        return output.getvalue()
+
+
+def generate_variants(image_hash):
+    """Generate the WebP copy and the JPEG/WebP thumbnails of a stored image."""
+    store = get_store()
+    with Image.open(io.BytesIO(store.read(image_hash))) as original:
+        image = original.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, "WEBP", quality=80)
+    store.put_variant(image_hash, "webp", output.getvalue())
+
+    for size in THUMBNAIL_SIZES:
+        thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        for image_format, suffix in (("JPEG", "jpeg"), ("WEBP", "webp")):
+            output = io.BytesIO()
+            thumbnail.save(output, image_format, quality=80)
+            store.put_variant(image_hash, f"{size}.{suffix}", output.getvalue())
+
+
+def ensure_variants(image_hash):
+    """Generate the variants of a stored image unless they exist or Pillow is missing."""
+    store = get_store()
+    if Image is not None and store.exists(image_hash) and not store.exists(image_hash, "webp"):
+        generate_variants(image_hash)
+
+
+def choose_variant(image_hash, size=None, accept_webp=False):
+    """
+    Return (variant, mimetype) of the best stored file for a request. Falls
+    back to the original while the variants are still being generated.
+    """
+    store = get_store()
+    candidates = []
+    if size in THUMBNAIL_SIZES:
+        if accept_webp:
+            candidates.append((f"{size}.webp", "image/webp"))
+        candidates.append((f"{size}.jpeg", "image/jpeg"))
+    elif accept_webp:
+        candidates.append(("webp", "image/webp"))
+
+    for variant, mimetype in candidates:
+        if store.exists(image_hash, variant):
+            return variant, mimetype
+
+    with open(store.path(image_hash), "rb") as file:
+        image_type = detect_type(file.read(12))
+    return None, MIME_TYPES.get(image_type, "application/octet-stream")
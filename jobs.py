@@ -0,0 +1,213 @@
+"""
+Persistent background jobs for work that does not belong on the request path.
+
+Jobs are rows of the jobs table, so they survive restarts: purging a removed
+ad with all of its threads, generating image variants, rebuilding the search
+index and periodic cleanup of orphaned rows. A job enqueued with a key is
+queued only once; enqueueing the same key while it is pending does nothing,
+and the handlers are written so that running a job twice is harmless. A
+failing job is retried with exponential backoff up to JOB_MAX_ATTEMPTS times
+and then kept as failed. A job whose worker died is taken over by another
+worker when its lease runs out.
+
+Each web process runs JOB_WORKERS worker threads, started with the
+application, so that queued and retried jobs run after a restart too.
+With JOB_WORKERS=0 jobs are only run by separate worker processes.
+
+Usage:
+    python jobs.py                          run a pool of workers
+    python jobs.py enqueue KIND [ARG ...]   queue a job by hand
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import config
+import db
+import images
+import messages
+import sessions
+
+LEASE_SECONDS = 300
+RETRY_DELAY = 5
+FAILED_RETENTION = 7 * 24 * 3600
+
+logger = logging.getLogger("friendapp.jobs")
+
+
+def cleanup():
+    """
+    Delete expired sessions, rows left behind by deleted threads and ads, and
+    old failed jobs, and requeue the purge of removed ads whose job was lost.
+    """
+    sessions.purge_expired_sessions()
+    db.execute("DELETE FROM thread_participants WHERE thread_id NOT IN (SELECT id FROM threads)")
+    db.execute("DELETE FROM message_classes WHERE message_id NOT IN (SELECT id FROM messages)")
+    db.execute("DELETE FROM jobs WHERE state = 'failed' AND run_at < ?",
+               [time.time() - FAILED_RETENTION])
+    for (message_id,) in db.query("SELECT id FROM messages WHERE deleted = 1"):
+        enqueue("purge_message", message_id, key=f"purge_message:{message_id}")
+
+
+JOBS = {
+    "purge_message": messages.purge_message,
+    "image_variants": images.ensure_variants,
+    "rebuild_search_index": messages.rebuild_search_index,
+    "cleanup": cleanup,
+}
+
+
+def enqueue(kind, *args, key=None, delay=0):
+    """
+    Queue a job that calls JOBS[kind](*args). A job with the same key that
+    is still queued or running is not queued again; a failed one is retried.
+    """
+    if kind not in JOBS:
+        raise ValueError(f"unknown job: {kind}")
+    sql = """
+    INSERT INTO jobs (kind, args, key, run_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT (key) DO UPDATE
+    SET state = 'queued', attempts = 0, run_at = excluded.run_at, last_error = NULL
+    WHERE jobs.state = 'failed'
+    """
+    db.execute(sql, [kind, json.dumps(args), key, time.time() + delay])
+    _start_embedded_workers()
+    _wake.set()
+
+
+def claim():
+    """Take the oldest due job for this worker, or return None."""
+    now = time.time()
+    sql = """
+    UPDATE jobs
+    SET state = 'running', attempts = attempts + 1, locked_until = ?
+    WHERE id = (SELECT id FROM jobs WHERE state = 'queued' AND run_at <= ?
+                ORDER BY run_at LIMIT 1)
+    RETURNING id, kind, args, attempts
+    """
+    rows = db.query(sql, [now + LEASE_SECONDS, now])
+    return rows[0] if rows else None
+
+
+def requeue_expired():
+    """Put back the running jobs whose lease has run out."""
+    sql = "UPDATE jobs SET state = 'queued' WHERE state = 'running' AND locked_until < ?"
+    db.execute(sql, [time.time()])
+
+
+def run(job):
+    """Run a claimed job; delete it when done, otherwise retry it later or mark it failed."""
+    try:
+        JOBS[job["kind"]](*json.loads(job["args"]))
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        logger.exception("Job %s %s failed (attempt %d)", job["id"], job["kind"], job["attempts"])
+        if job["attempts"] >= config.job_max_attempts:
+            sql = "UPDATE jobs SET state = 'failed', last_error = ? WHERE id = ?"
+            db.execute(sql, [repr(error), job["id"]])
+        else:
+            sql = "UPDATE jobs SET state = 'queued', run_at = ?, last_error = ? WHERE id = ?"
+            retry_at = time.time() + RETRY_DELAY * 2 ** (job["attempts"] - 1)
+            db.execute(sql, [retry_at, repr(error), job["id"]])
+        return
+    db.execute("DELETE FROM jobs WHERE id = ?", [job["id"]])
+
+
+_wake = threading.Event()
+_next_cleanup = 0.0
+_workers_pid = None
+_workers_lock = threading.Lock()
+_standalone = False
+
+
+def work(stop):
+    """
+    The loop of one worker thread: run due jobs, otherwise wait for new ones.
+    An error outside of a job, such as a locked database, is logged and the
+    loop goes on after JOB_POLL_INTERVAL, so the worker never dies.
+    """
+    global _next_cleanup  # pylint: disable=global-statement
+    db.open_thread_connection()
+    try:
+        while not stop.is_set():
+            try:
+                job = claim()
+                if job is not None:
+                    run(job)
+                    continue
+                requeue_expired()
+                if time.monotonic() >= _next_cleanup:
+                    _next_cleanup = time.monotonic() + config.job_cleanup_interval
+                    enqueue("cleanup", key="cleanup")
+                    continue
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Job worker error")
+                stop.wait(config.job_poll_interval)
+                continue
+            _wake.wait(config.job_poll_interval)
+            _wake.clear()
+    finally:
+        db.close_connection()
+
+
+def start_workers(count, stop):
+    """Start count daemon worker threads that run until stop is set."""
+    workers = [
+        threading.Thread(target=work, args=(stop,), name=f"job-worker-{i}", daemon=True)
+        for i in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def _start_embedded_workers():
+    """Start the worker threads of a web process once per process."""
+    global _workers_pid  # pylint: disable=global-statement
+    if _standalone or config.job_workers <= 0 or _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid != os.getpid():
+            _workers_pid = os.getpid()
+            start_workers(config.job_workers, threading.Event())
+
+
+def init_app(app):
+    """
+    Starts the worker threads with the application, and checks before each
+    request that a forked worker process has started its own.
+    """
+    _start_embedded_workers()
+    app.before_request(_start_embedded_workers)
+
+
+def main(argv):
+    """Command line entry point."""
+    global _standalone  # pylint: disable=global-statement
+    _standalone = True
+    if len(argv) >= 3 and argv[1] == "enqueue":
+        args = [int(arg) if arg.isdigit() else arg for arg in argv[3:]]
+        enqueue(argv[2], *args)
+        print(f"Queued {argv[2]}")
+        return 0
+    if len(argv) > 1:
+        print(__doc__)
+        return 1
+
+    logging.basicConfig(level=logging.INFO)
+    stop = threading.Event()
+    workers = start_workers(max(config.job_workers, 1), stop)
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+        _wake.set()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,69 @@
+"""
+Request-scoped batch loaders.
+
+A view names the rows it is going to need with prime() and reads them with
+load() or load_many(). Everything primed or requested before a load is
+fetched with one batch query per entity type, and each id is fetched at
+most once per request, so a page costs a constant number of queries however
+many rows it shows.
+"""
+
+from flask import g
+
+import messages
+import users
+
+BATCH_FUNCTIONS = {
+    "messages": messages.get_messages_with_classes,
+    "users": users.get_users,
+}
+
+
+class Loader:
+    """Coalesces the lookups of one entity type into batch calls."""
+
+    def __init__(self, batch_function):
+        self.batch_function = batch_function
+        self._values = {}
+        self._pending = set()
+
+    def prime(self, *keys):
+        """Queues keys to be fetched with the next batch."""
+        self._pending.update(key for key in keys if key not in self._values)
+
+    def load_many(self, keys):
+        """Returns the rows of the given keys, None for missing ones."""
+        self.prime(*keys)
+        if self._pending:
+            found = self.batch_function(list(self._pending))
+            for key in self._pending:
+                self._values[key] = found.get(key)
+            self._pending.clear()
+        return [self._values[key] for key in keys]
+
+    def load(self, key):
+        """Returns the row of a single key, or None."""
+        return self.load_many([key])[0]
+
+
+def get_loader(name):
+    """Returns the loader of an entity type for the current request."""
+    request_loaders = g.setdefault("loaders", {})
+    if name not in request_loaders:
+        request_loaders[name] = Loader(BATCH_FUNCTIONS[name])
+    return request_loaders[name]
+
+
+def prime(name, *keys):
+    """Queues keys of an entity type for the next batch."""
+    get_loader(name).prime(*keys)
+
+
+def load(name, key):
+    """Returns one row of an entity type."""
+    return get_loader(name).load(key)
+
+
+def load_many(name, keys):
+    """Returns rows of an entity type in the order of the keys."""
+    return get_loader(name).load_many(keys)
@@ -2,98 +2,337 @@
 Module for handling messages and message classes in the Friend App.
 """
 
+import re
+
+from markupsafe import Markup, escape
+
+import cache
 import db
+import recommend
+import threads
 
+PAGE_SIZE = 20
 
-def add_class_to_message(message_id, class_title, class_value):
-    """Stub function for Pylint. Adds a class to a message in the database."""
-    sql = "INSERT INTO message_classes (message_id, title, value) VALUES (?, ?, ?)"
-    db.execute(sql, [message_id, class_title, class_value])
 
+def add_classes_to_message(message_id, classes_selected):
+    """Add the selected (title, value) classes to a message in one batch."""
+    class_ids = get_class_ids()
+    sql = "INSERT INTO message_classes (message_id, class_id) VALUES (?, ?)"
+    db.execute_many(sql, [(message_id, class_ids[entry]) for entry in classes_selected])
 
-def get_messages():
-    """Return all messages with basic info including user data."""
+
+def get_messages(before_id=None, after_id=None, limit=PAGE_SIZE):
+    """
+    Return one page of messages, newest first, with basic user data.
+
+    Pages are keyed on m.id: before_id gives the next older page and after_id
+    the next newer one. The result holds the rows and the "older"/"newer"
+    cursors, which are None when there is no such page.
+    """
     sql = """
     SELECT m.id, m.title, m.description, m.user_id, u.username, u.age as user_age
     FROM messages m
     JOIN users u ON m.user_id = u.id
-    ORDER BY m.id DESC
+    WHERE m.deleted = 0
     """
-    return db.query(sql)
+    if after_id is not None:
+        rows = db.query(sql + "AND m.id > ? ORDER BY m.id ASC LIMIT ?", [after_id, limit + 1])
+        has_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_older = bool(rows) and _has_message("id < ?", rows[-1]["id"])
+    else:
+        if before_id is not None:
+            rows = db.query(sql + "AND m.id < ? ORDER BY m.id DESC LIMIT ?", [before_id, limit + 1])
+        else:
+            rows = db.query(sql + "ORDER BY m.id DESC LIMIT ?", [limit + 1])
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = bool(rows) and before_id is not None and _has_message("id > ?", rows[0]["id"])
+
+    return {
+        "messages": rows,
+        "older": rows[-1]["id"] if has_older else None,
+        "newer": rows[0]["id"] if has_newer else None,
+    }
 
 
+def _has_message(condition, message_id):
+    """Probe the primary key for a message on the other side of a cursor."""
+    sql = f"SELECT 1 FROM messages WHERE {condition} AND deleted = 0 LIMIT 1"
+    return bool(db.query(sql, [message_id]))
+
+
+@cache.cached("messages")
 def get_message(message_id):
     """Return a single message by ID."""
     sql = """
     SELECT m.id, m.title, m.description, m.user_id, u.username, u.age as user_age
     FROM messages m
     JOIN users u ON m.user_id = u.id
-    WHERE m.id = ?
+    WHERE m.id = ? AND m.deleted = 0
     """
     result = db.query(sql, [message_id])
     return result[0] if result else None
 
 
+def get_messages_with_classes(message_ids):
+    """
+    Return {message id: message} for the given ads, each as a dict with the
+    owner's basic data and a "classes" list, using one query for the ads
+    and one for all of their classes. Ads already in the read cache are not
+    fetched again.
+    """
+    found = cache.get_many("messages", message_ids)
+    missing = [message_id for message_id in set(message_ids) if message_id not in found]
+    if missing:
+        placeholders = ", ".join("?" * len(missing))
+        sql = f"""
+        SELECT m.id, m.title, m.description, m.user_id, u.username, u.age as user_age
+        FROM messages m
+        JOIN users u ON m.user_id = u.id
+        WHERE m.id IN ({placeholders}) AND m.deleted = 0
+        """
+        fetched = {row["id"]: row for row in db.query(sql, missing)}
+        cache.set_many("messages", fetched)
+        found.update(fetched)
+    if not found:
+        return {}
+
+    result = {message_id: {**dict(row), "classes": []} for message_id, row in found.items()}
+    placeholders = ", ".join("?" * len(result))
+    sql = f"""
+    SELECT mc.message_id, c.title, c.value
+    FROM message_classes mc
+    JOIN classes c ON c.id = mc.class_id
+    WHERE mc.message_id IN ({placeholders})
+    ORDER BY mc.message_id, c.id
+    """
+    for message_id, title, value in db.query(sql, list(result)):
+        result[message_id]["classes"].append({"title": title, "value": value})
+    return result
+
+
 def add_message(title, description, age, user_id, classes_selected):
     """Add a new message with optional classes."""
-    sql = "INSERT INTO messages (title, description, age, user_id) VALUES (?, ?, ?, ?)"
-    message_id = db.execute(sql, [title, description, age, user_id])
-
-    for class_title, class_value in classes_selected:
-        add_class_to_message(message_id, class_title, class_value)
+    with db.transaction():
+        version = recommend.data_version()
+        sql = "INSERT INTO messages (title, description, age, user_id) VALUES (?, ?, ?, ?)"
+        message_id = db.execute(sql, [title, description, age, user_id])
+        add_classes_to_message(message_id, classes_selected)
+        versions = (version, recommend.data_version())
+    recommend.refresh_ad(message_id, *versions)
 
     return message_id
 
 
 def update_message(message_id, user_id, title, description, classes_selected):
     """Update an existing message."""
-    sql = "UPDATE messages SET title = ?, description = ? WHERE id = ? AND user_id = ?"
-    db.execute(sql, [title, description, message_id, user_id])
+    with db.transaction():
+        version = recommend.data_version()
+        sql = "UPDATE messages SET title = ?, description = ? WHERE id = ? AND user_id = ?"
+        db.execute(sql, [title, description, message_id, user_id])
 
-    sql = "DELETE FROM message_classes WHERE message_id = ?"
-    db.execute(sql, [message_id])
-
-    for class_title, class_value in classes_selected:
-        add_class_to_message(message_id, class_title, class_value)
+        sql = "DELETE FROM message_classes WHERE message_id = ?"
+        db.execute(sql, [message_id])
+        add_classes_to_message(message_id, classes_selected)
+        versions = (version, recommend.data_version())
+    cache.invalidate("messages", int(message_id))
+    recommend.refresh_ad(int(message_id), *versions)
 
 
 def remove_message(message_id, user_id):
-    """Remove a message by ID and its associated classes."""
-    sql = "DELETE FROM message_classes WHERE message_id = ?"
-    db.execute(sql, [message_id])
-    
-    threads_result = db.query("SELECT id FROM threads WHERE ad_id = ?", [message_id])
-    for thread in threads_result:
-        thread_id = thread[0]
-        db.execute("DELETE FROM thread_messages WHERE thread_id = ?", [thread_id])
-        db.execute("DELETE FROM threads WHERE id = ?", [thread_id])
+    """
+    Hide a message at once by marking it deleted. The row, its classes and
+    its threads are deleted afterwards by purge_message() in a background job.
+    """
+    with db.transaction():
+        version = recommend.data_version()
+        sql = "UPDATE messages SET deleted = 1 WHERE id = ? AND user_id = ?"
+        db.execute(sql, [message_id, user_id])
+        versions = (version, recommend.data_version())
+    cache.invalidate("messages", int(message_id))
+    recommend.refresh_ad(int(message_id), *versions)
 
-    sql = "DELETE FROM messages WHERE id = ? AND user_id = ?"
-    db.execute(sql, [message_id, user_id])
+
+def purge_message(message_id):
+    """
+    Delete a message marked deleted together with its threads and classes.
+    The threads go in chunks, each in its own short transaction, so that a
+    popular ad does not hold the write lock for long. Safe to run again.
+    """
+    if not db.query("SELECT 1 FROM messages WHERE id = ? AND deleted = 1", [message_id]):
+        return
+    while threads.remove_threads_by_message(message_id):
+        pass
+    with db.transaction():
+        db.execute("DELETE FROM message_classes WHERE message_id = ?", [message_id])
+        db.execute("DELETE FROM messages WHERE id = ?", [message_id])
+
+
+@cache.cached("classes", maxsize=1, ttl=None)
+def get_class_list():
+    """Return every class as an (id, title, value) row. The taxonomy is loaded only once."""
+    return db.query("SELECT id, title, value FROM classes ORDER BY id")
 
 
 def get_all_classes():
-    """Return all available message classes."""
-    sql = "SELECT title, value FROM classes"
-    result = db.query(sql)
+    """Return all available message values grouped by class title."""
     classes_dict = {}
-    for title, value in result:
-        if title not in classes_dict:
-            classes_dict[title] = []
-        classes_dict[title].append(value)
+    for row in get_class_list():
+        classes_dict.setdefault(row["title"], []).append(row["value"])
     return classes_dict
 
 
+def get_class_ids():
+    """Return a {(title, value): class id} mapping of the taxonomy."""
+    return {(row["title"], row["value"]): row["id"] for row in get_class_list()}
+
+
 def get_classes(message_id):
     """Return classes for a specific message."""
-    sql = "SELECT title, value FROM message_classes WHERE message_id = ?"
+    sql = """
+    SELECT c.title, c.value
+    FROM message_classes mc
+    JOIN classes c ON c.id = mc.class_id
+    WHERE mc.message_id = ?
+    ORDER BY c.id
+    """
     result = db.query(sql, [message_id])
     return [{"title": title, "value": value} for title, value in result]
 
 
-def find_messages(query):
-    """Search messages by a substring in the title or description."""
-    sql = "SELECT id, title FROM messages WHERE title LIKE ? OR description LIKE ? ORDER BY id DESC"
-    q = f"%{query}%"
-    return db.query(sql, [q, q])
+def get_facets():
+    """
+    Return every class with the number of ads carrying it, grouped by class
+    title. The counts are read from class_counts, which triggers keep up to
+    date, so this costs one row per class however many ads there are.
+    """
+    sql = """
+    SELECT c.id, c.title, c.value, COALESCE(cc.message_count, 0) AS message_count
+    FROM classes c
+    LEFT JOIN class_counts cc ON cc.class_id = c.id
+    ORDER BY c.id
+    """
+    facets = {}
+    for row in db.query(sql):
+        facets.setdefault(row["title"], []).append(row)
+    return facets
+
+
+def browse(class_ids=(), min_age=None, max_age=None, before_id=None, limit=PAGE_SIZE):
+    """
+    Return one page of ads, newest first, that carry the given classes and
+    whose age is within [min_age, max_age].
+
+    Classes with the same title are alternatives and different titles must
+    all match. When one class is the rarest requirement, the page is read
+    from that class's index in message id order, so rare classes do not
+    scan the whole feed. The result holds the rows and the "older" cursor.
+    """
+    groups = {}
+    for row in get_class_list():
+        if row["id"] in class_ids:
+            groups.setdefault(row["title"], []).append(row["id"])
+
+    counts = {}
+    if groups:
+        ids = [class_id for ids in groups.values() for class_id in ids]
+        sql = "SELECT class_id, message_count FROM class_counts WHERE class_id IN ({})"
+        class_counts = dict(db.query(sql.format(", ".join("?" * len(ids))), ids))
+        for title, ids in groups.items():
+            counts[title] = sum(class_counts.get(class_id, 0) for class_id in ids)
+
+    rarest = min(groups, key=counts.get, default=None)
+    params = []
+    if rarest is not None and len(groups[rarest]) == 1:
+        sql = """
+        SELECT m.id, m.title, m.description, m.user_id, u.username, u.age AS user_age
+        FROM message_classes d
+        JOIN messages m ON m.id = d.message_id
+        JOIN users u ON m.user_id = u.id
+        WHERE d.class_id = ? AND m.deleted = 0
+        """
+        params += groups.pop(rarest)
+        id_column = "d.message_id"
+    else:
+        sql = """
+        SELECT m.id, m.title, m.description, m.user_id, u.username, u.age AS user_age
+        FROM messages m
+        JOIN users u ON m.user_id = u.id
+        WHERE m.deleted = 0
+        """
+        id_column = "m.id"
+
+    for ids in groups.values():
+        placeholders = ", ".join("?" * len(ids))
+        sql += f"""
+        AND EXISTS (SELECT 1 FROM message_classes mc
+                    WHERE mc.message_id = m.id AND mc.class_id IN ({placeholders}))
+        """
+        params += ids
+    if min_age is not None:
+        sql += "AND m.age >= ? "
+        params.append(min_age)
+    if max_age is not None:
+        sql += "AND m.age <= ? "
+        params.append(max_age)
+    if before_id is not None:
+        sql += f"AND {id_column} < ? "
+        params.append(before_id)
+    sql += f"ORDER BY {id_column} DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = db.query(sql, params)
+    return {
+        "messages": rows[:limit],
+        "older": rows[limit - 1]["id"] if len(rows) > limit else None,
+    }
+
+
+def find_messages(query, classes_selected=(), page=1, limit=PAGE_SIZE):
+    """
+    Full-text search over titles and descriptions, ranked by BM25.
+
+    Every word of the query must match as a prefix. Results can be narrowed
+    to ads carrying all of the given (title, value) classes. Returns one page
+    of results with an HTML-safe snippet and whether more pages follow.
+    """
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        return {"results": [], "has_more": False}
+
+    sql = """
+    SELECT m.id, m.title,
+           snippet(messages_fts, 1, char(2), char(3), '…', 16) AS snippet
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    WHERE messages_fts MATCH ? AND m.deleted = 0
+    """
+    params = [" ".join(f'"{term}"*' for term in terms)]
+    class_ids = get_class_ids()
+    for entry in classes_selected:
+        sql += """
+        AND EXISTS (SELECT 1 FROM message_classes mc
+                    WHERE mc.message_id = m.id AND mc.class_id = ?)
+        """
+        params.append(class_ids[entry])
+    sql += "ORDER BY bm25(messages_fts, 10.0, 1.0) LIMIT ? OFFSET ?"
+    params += [limit + 1, (page - 1) * limit]
+
+    rows = db.query(sql, params)
+    results = [
+        {"id": row["id"], "title": row["title"], "snippet": _highlight(row["snippet"])}
+        for row in rows[:limit]
+    ]
+    return {"results": results, "has_more": len(rows) > limit}
+
+
+def _highlight(snippet):
+    """Escape a search snippet and turn the match markers into <mark> tags."""
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace("\x02", "<mark>").replace("\x03", "</mark>"))
+
 
+def rebuild_search_index():
+    """Rebuild the full-text index from the messages table."""
+    db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
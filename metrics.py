@@ -0,0 +1,265 @@
+"""
+Prometheus-style operational metrics for the Friend App.
+
+Each process keeps its samples in memory and writes them at most once per
+METRICS_FLUSH_INTERVAL seconds to METRICS_DIR/<pid>.json. The /metrics
+endpoint merges the files of all worker processes: counters and histograms
+are summed over every file, gauges only over processes that are still alive,
+and active sessions are counted once per user. Without METRICS_DIR only the
+current process is reported.
+"""
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import Response, abort, current_app, g, request, session
+
+import cache
+import config
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ACTIVE_SESSION_WINDOW = 300
+
+_lock = threading.Lock()
+_samples = {}
+_sessions = {}
+_registry = []
+_last_flush = 0.0
+
+
+class Metric:
+    """Base class of the metric types; registers the metric for exposition."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def _add(self, sample_name, labels, amount):
+        key = (self.name, sample_name, tuple(sorted(labels.items())))
+        with _lock:
+            _samples[key] = _samples.get(key, 0.0) + amount
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter."""
+        self._add(self.name, labels, amount)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, summed over the live processes."""
+
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        """Increment the gauge."""
+        self._add(self.name, labels, amount)
+
+    def dec(self, amount=1, **labels):
+        """Decrement the gauge."""
+        self._add(self.name, labels, -amount)
+
+
+class Histogram(Metric):
+    """Cumulative bucket counts, sum and count of observed values."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        """Record one observation."""
+        for bound in self.buckets:
+            if value <= bound:
+                self._add(self.name + "_bucket", {**labels, "le": str(bound)}, 1)
+        self._add(self.name + "_bucket", {**labels, "le": "+Inf"}, 1)
+        self._add(self.name + "_sum", labels, value)
+        self._add(self.name + "_count", labels, 1)
+
+
+REQUEST_LATENCY = Histogram(
+    "friendapp_request_duration_seconds", "Request latency by endpoint.", ("endpoint",)
+)
+REQUESTS = Counter(
+    "friendapp_requests_total", "Responses by endpoint and status code.", ("endpoint", "status")
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "friendapp_requests_in_progress", "Requests currently being handled."
+)
+DB_STATEMENTS = Counter("friendapp_db_statements_total", "SQL statements executed.")
+DB_SECONDS = Counter("friendapp_db_statement_seconds_total", "Time spent in SQL statements.")
+DB_COMMITS = Counter("friendapp_db_commits_total", "Committed transactions.")
+IMAGE_BYTES = Counter(
+    "friendapp_image_bytes_served_total", "Profile image bytes sent.", ("variant",)
+)
+ACTIVE_SESSIONS = Gauge(
+    "friendapp_active_sessions",
+    f"Logged-in users seen during the last {ACTIVE_SESSION_WINDOW} seconds.",
+)
+WRITE_BATCH_SIZE = Histogram(
+    "friendapp_write_batch_operations", "Write operations per group commit.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+CACHE_EVENTS = Counter(
+    "friendapp_cache_events_total", "Read cache hits, misses and evictions.", ("cache", "event")
+)
+
+
+def snapshot():
+    """Return this process' samples, cache counters and active sessions."""
+    with _lock:
+        samples = [[metric, name, list(labels), value]
+                   for (metric, name, labels), value in _samples.items()]
+        sessions = dict(_sessions)
+    for cache_name, stats in cache.stats().items():
+        for event in ("hits", "misses", "evictions"):
+            labels = [["cache", cache_name], ["event", event]]
+            samples.append([CACHE_EVENTS.name, CACHE_EVENTS.name, labels, stats[event]])
+    return {"pid": os.getpid(), "samples": samples, "sessions": sessions}
+
+
+def flush(force=False):
+    """Write this process' snapshot to the metrics directory, at most once per interval."""
+    global _last_flush  # pylint: disable=global-statement
+    if not config.metrics_dir:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < config.metrics_flush_interval:
+        return
+    _last_flush = now
+    os.makedirs(config.metrics_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=config.metrics_dir, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(snapshot(), file)
+    os.replace(tmp_path, os.path.join(config.metrics_dir, f"{os.getpid()}.json"))
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _snapshots():
+    if not config.metrics_dir:
+        return [snapshot()]
+    flush(force=True)
+    found = []
+    for filename in os.listdir(config.metrics_dir):
+        if filename.endswith(".json"):
+            try:
+                with open(os.path.join(config.metrics_dir, filename), encoding="utf-8") as file:
+                    found.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+    return found
+
+
+def collect():
+    """Merge the snapshots of all processes into {metric: {(name, labels): value}}."""
+    kinds = {metric.name: metric.kind for metric in _registry}
+    merged = {}
+    sessions = {}
+    for data in _snapshots():
+        alive = data["pid"] == os.getpid() or _process_alive(data["pid"])
+        for metric, name, labels, value in data["samples"]:
+            if kinds.get(metric) == "gauge" and not alive:
+                continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged.setdefault(metric, {})
+            merged[metric][key] = merged[metric].get(key, 0.0) + value
+        for user_id, seen in data["sessions"].items():
+            sessions[user_id] = max(sessions.get(user_id, 0), seen)
+
+    cutoff = time.time() - ACTIVE_SESSION_WINDOW
+    active = sum(1 for seen in sessions.values() if seen >= cutoff)
+    merged[ACTIVE_SESSIONS.name] = {(ACTIVE_SESSIONS.name, ()): active}
+    return merged
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    merged = collect()
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for (name, labels), value in sorted(merged.get(metric.name, {}).items(), key=_sort_key):
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels)
+            label_text = "{" + label_text + "}" if label_text else ""
+            value = int(value) if float(value).is_integer() else value
+            lines.append(f"{name}{label_text} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _sort_key(item):
+    """Order samples by name and labels, with histogram buckets in ascending order."""
+    (name, labels), _ = item
+    other = tuple(pair for pair in labels if pair[0] != "le")
+    bound = next((float(val) for key, val in labels if key == "le"), 0.0)
+    return (name, other, bound)
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_PROGRESS.inc()
+
+
+def _record_request(status):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return
+    endpoint = request.endpoint or "unknown"
+    REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=str(status))
+    REQUESTS_IN_PROGRESS.dec()
+
+
+def _finish_request(response):
+    _record_request(response.status_code)
+    has_session = current_app.config["SESSION_COOKIE_NAME"] in request.cookies
+    user_id = session.get("user_id") if has_session else None
+    if user_id:
+        with _lock:
+            _sessions[str(user_id)] = time.time()
+    flush()
+    return response
+
+
+def _teardown_request(exception=None):
+    _record_request(500)
+
+
+def metrics_view():
+    """Serves the merged metrics. Requires the METRICS_TOKEN bearer token if set."""
+    if config.metrics_token:
+        if request.headers.get("Authorization") != f"Bearer {config.metrics_token}":
+            abort(403)
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    """Registers the request instrumentation and the /metrics endpoint."""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    atexit.register(flush, True)
@@ -0,0 +1,182 @@
+"""
+Migration runner for the Friend App database.
+
+Applies the numbered migrations in migrations/ that are not yet recorded in
+the schema_version table, and checks that the hot queries use indexes.
+
+Usage:
+    python migrate.py           apply pending migrations
+    python migrate.py check     fail if a hot query scans a whole table
+    python migrate.py rebuild-search
+                                rebuild the full-text index of the ads
+"""
+
+import importlib.util
+import os
+import re
+import sqlite3
+import sys
+
+import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.(sql|py)$")
+ADD_COLUMN = re.compile(r"^ALTER\s+TABLE\s+(\w+)\s+ADD\s+COLUMN\s+(\w+)", re.IGNORECASE)
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+def list_migrations():
+    """Return (version, name, path) for every migration file, in order."""
+    found = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            path = os.path.join(MIGRATIONS_DIR, filename)
+            found.append((int(match.group(1)), match.group(2), path))
+    return sorted(found)
+
+
+def split_statements(script):
+    """Split an SQL script into complete statements, keeping trigger bodies whole."""
+    statements = []
+    current = ""
+    for line in script.splitlines(keepends=True):
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    if current.strip() and not current.strip().startswith("--"):
+        statements.append(current.strip())
+    return statements
+
+
+def column_exists(con, table, column):
+    """Return True if the table already has the given column."""
+    return any(row["name"] == column for row in con.execute(f"PRAGMA table_xinfo({table})"))
+
+
+def run_sql(con, path):
+    """Run an SQL migration. ADD COLUMN is skipped when the column already exists."""
+    with open(path, encoding="utf-8") as file:
+        script = file.read()
+    for statement in split_statements(script):
+        body = "\n".join(
+            line for line in statement.splitlines() if not line.strip().startswith("--")
+        ).strip()
+        match = ADD_COLUMN.match(body)
+        if match and column_exists(con, match.group(1), match.group(2)):
+            continue
+        con.execute(statement)
+
+
+def run_python(con, path):
+    """Run a Python migration by calling its upgrade(con) function."""
+    spec = importlib.util.spec_from_file_location(os.path.basename(path)[:-3], path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.upgrade(con)
+
+
+def applied_versions(con):
+    """Return the set of migration versions already applied."""
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    return {row[0] for row in con.execute("SELECT version FROM schema_version")}
+
+
+def migrate():
+    """Apply all pending migrations, each one in its own transaction."""
+    con = db.get_connection()
+    applied = applied_versions(con)
+    for version, name, path in list_migrations():
+        if version in applied:
+            continue
+        with db.transaction():
+            if path.endswith(".py"):
+                run_python(con, path)
+            else:
+                run_sql(con, path)
+            con.execute(
+                "INSERT INTO schema_version (version, name) VALUES (?, ?)", [version, name]
+            )
+        print(f"Applied migration {version:03d}_{name}")
+
+
+def hot_queries():
+    """Return (name, function) pairs for the queries that run on every page view."""
+    import messages  # pylint: disable=import-outside-toplevel
+    import threads  # pylint: disable=import-outside-toplevel
+    import users  # pylint: disable=import-outside-toplevel
+
+    # The class taxonomy is read once per process and then served from cache.
+    messages.get_class_list()
+    return [
+        ("threads.get_user_threads", lambda: threads.get_user_threads(1)),
+        ("threads.get_user_threads older",
+         lambda: threads.get_user_threads(1, ("2024-01-01 00:00:00", 100))),
+        ("threads.get_unread_messages", lambda: threads.get_unread_messages(1)),
+        ("threads.get_messages", lambda: threads.get_messages(1)),
+        ("threads.get_messages earlier", lambda: threads.get_messages(1, before_id=100)),
+        ("threads.get_messages after", lambda: threads.get_messages(1, after_id=100)),
+        ("threads.get_threads_by_message", lambda: threads.get_threads_by_message(1)),
+        ("users.get_user", lambda: users.get_user(1)),
+        ("users.get_messages", lambda: users.get_messages(1)),
+        ("messages.get_messages", lambda: messages.get_messages(before_id=100)),
+        ("messages.get_messages newer", lambda: messages.get_messages(after_id=100)),
+        ("messages.get_message", lambda: messages.get_message(1)),
+        ("messages.get_classes", lambda: messages.get_classes(1)),
+        ("messages.browse", lambda: messages.browse([2], before_id=100)),
+        ("messages.browse classes and age",
+         lambda: messages.browse([2, 7], min_age=20, max_age=40, before_id=100)),
+    ]
+
+
+def check_query_plans():
+    """
+    Run every hot query, EXPLAIN the statements it issues and return a list of
+    (name, sql, plan detail) for each full table scan found.
+    """
+    con = db.get_connection()
+    problems = []
+    for name, run in hot_queries():
+        statements = []
+        con.set_trace_callback(statements.append)
+        try:
+            run()
+        finally:
+            con.set_trace_callback(None)
+        for sql in statements:
+            for row in con.execute("EXPLAIN QUERY PLAN " + sql):
+                if FULL_SCAN.match(row["detail"]):
+                    problems.append((name, " ".join(sql.split()), row["detail"]))
+    return problems
+
+
+def main(argv):
+    """Command line entry point."""
+    command = argv[1] if len(argv) > 1 else "migrate"
+    if command == "migrate":
+        migrate()
+        return 0
+    if command == "check":
+        problems = check_query_plans()
+        for name, sql, detail in problems:
+            print(f"{name}: {detail}\n    {sql}")
+        print("OK" if not problems else f"{len(problems)} full table scan(s)")
+        return 1 if problems else 0
+    if command == "rebuild-search":
+        import messages  # pylint: disable=import-outside-toplevel
+        messages.rebuild_search_index()
+        print("Search index rebuilt")
+        return 0
+    print(__doc__)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
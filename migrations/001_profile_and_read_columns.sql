@@ -0,0 +1,4 @@
+-- Columns used by the application code but missing from schema.sql.
+ALTER TABLE users ADD COLUMN age INTEGER;
+ALTER TABLE users ADD COLUMN bio TEXT;
+ALTER TABLE thread_messages ADD COLUMN read_by_user INTEGER NOT NULL DEFAULT 0;
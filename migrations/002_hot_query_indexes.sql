@@ -0,0 +1,22 @@
+-- threads.get_user_threads: user1_id = ? OR user2_id = ? (multi-index OR)
+CREATE INDEX IF NOT EXISTS threads_user1_idx ON threads (user1_id, id);
+CREATE INDEX IF NOT EXISTS threads_user2_idx ON threads (user2_id, id);
+
+-- threads.get_threads_by_message and ad removal
+CREATE INDEX IF NOT EXISTS threads_ad_idx ON threads (ad_id);
+
+-- threads.get_messages: thread_id = ? ORDER BY created_at
+CREATE INDEX IF NOT EXISTS thread_messages_thread_idx
+    ON thread_messages (thread_id, created_at);
+
+-- threads.get_unread_messages: only unread rows, already in display order
+CREATE INDEX IF NOT EXISTS thread_messages_unread_idx
+    ON thread_messages (created_at, sender_id, thread_id)
+    WHERE read_by_user = 0;
+
+-- users.get_messages: user_id = ? ORDER BY id DESC
+CREATE INDEX IF NOT EXISTS messages_user_idx ON messages (user_id, id);
+
+-- messages.get_classes: covering lookup by message_id
+CREATE INDEX IF NOT EXISTS message_classes_message_idx
+    ON message_classes (message_id, title, value);
@@ -0,0 +1,30 @@
+-- Full-text index over ads. unicode61 folds case for non-ASCII letters too,
+-- but keeps diacritics: in Finnish ä, ö and å are letters of their own, so
+-- "tää" and "taa" must not match each other.
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    title,
+    description,
+    content = 'messages',
+    content_rowid = 'id',
+    tokenize = "unicode61 remove_diacritics 0"
+);
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, title, description)
+    VALUES (new.id, new.title, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, title, description)
+    VALUES ('delete', old.id, old.title, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_fts_update
+AFTER UPDATE OF title, description ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, title, description)
+    VALUES ('delete', old.id, old.title, old.description);
+    INSERT INTO messages_fts (rowid, title, description)
+    VALUES (new.id, new.title, new.description);
+END;
+
+INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
@@ -0,0 +1,25 @@
+"""
+Moves profile images out of users.image into the content-addressed image
+store and leaves only their hash in the users table.
+"""
+
+import images
+
+import migrate
+
+
+def upgrade(con):
+    """Copy every stored BLOB to the image store, then drop the BLOB column."""
+    if not migrate.column_exists(con, "users", "image_hash"):
+        con.execute("ALTER TABLE users ADD COLUMN image_hash TEXT")
+    if not migrate.column_exists(con, "users", "image"):
+        return
+
+    store = images.get_store()
+    rows = con.execute("SELECT id, image FROM users WHERE image IS NOT NULL")
+    for user_id, image in rows.fetchall():
+        if image:
+            con.execute(
+                "UPDATE users SET image_hash = ? WHERE id = ?", [store.put(bytes(image)), user_id]
+            )
+    con.execute("ALTER TABLE users DROP COLUMN image")
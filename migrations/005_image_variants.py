@@ -0,0 +1,17 @@
+"""
+Generates thumbnails and WebP copies for images stored before the upload
+pipeline existed. Does nothing when Pillow is not installed.
+"""
+
+import images
+
+
+def upgrade(con):
+    """Generate the missing variants of every profile image."""
+    if images.Image is None:
+        return
+    store = images.get_store()
+    rows = con.execute("SELECT DISTINCT image_hash FROM users WHERE image_hash IS NOT NULL")
+    for (image_hash,) in rows.fetchall():
+        if store.exists(image_hash) and not store.exists(image_hash, "webp"):
+            images.generate_variants(image_hash)
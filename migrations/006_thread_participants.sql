@@ -0,0 +1,31 @@
+-- Read state per (thread, participant): the id of the last message the user
+-- has seen and how many messages from the other participant are unread.
+CREATE TABLE IF NOT EXISTS thread_participants (
+    thread_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    last_read_id INTEGER NOT NULL DEFAULT 0,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (thread_id, user_id),
+    FOREIGN KEY(thread_id) REFERENCES threads(id),
+    FOREIGN KEY(user_id) REFERENCES users(id)
+) WITHOUT ROWID;
+
+-- threads.get_unread_messages: only the threads of one user that have unread rows
+CREATE INDEX IF NOT EXISTS thread_participants_unread_idx
+    ON thread_participants (user_id, thread_id)
+    WHERE unread_count > 0;
+
+INSERT OR IGNORE INTO thread_participants (thread_id, user_id, last_read_id, unread_count)
+SELECT t.id, p.user_id,
+       COALESCE((SELECT MAX(tm.id) FROM thread_messages tm
+                 WHERE tm.thread_id = t.id
+                   AND (tm.sender_id = p.user_id OR tm.read_by_user = 1)), 0),
+       (SELECT COUNT(*) FROM thread_messages tm
+        WHERE tm.thread_id = t.id AND tm.sender_id != p.user_id AND tm.read_by_user = 0)
+FROM threads t
+JOIN (SELECT id, user1_id AS user_id FROM threads
+      UNION ALL
+      SELECT id, user2_id AS user_id FROM threads) p ON p.id = t.id;
+
+-- read_by_user is no longer read, so its partial index is only write overhead.
+DROP INDEX IF EXISTS thread_messages_unread_idx;
@@ -0,0 +1,4 @@
+-- Thread history is ordered and paginated by the monotonic message id, which
+-- an index on thread_id alone already stores in order (as the rowid).
+DROP INDEX IF EXISTS thread_messages_thread_idx;
+CREATE INDEX IF NOT EXISTS thread_messages_thread_idx ON thread_messages (thread_id);
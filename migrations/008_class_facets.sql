@@ -0,0 +1,48 @@
+-- message_classes references classes.id instead of repeating the title and
+-- value text on every row.
+CREATE TABLE message_classes_new (
+    message_id INTEGER NOT NULL,
+    class_id INTEGER NOT NULL,
+    PRIMARY KEY (message_id, class_id),
+    FOREIGN KEY(message_id) REFERENCES messages(id),
+    FOREIGN KEY(class_id) REFERENCES classes(id)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO message_classes_new (message_id, class_id)
+SELECT mc.message_id, c.id
+FROM message_classes mc
+JOIN classes c ON c.title = mc.title AND c.value = mc.value;
+
+DROP TABLE message_classes;
+ALTER TABLE message_classes_new RENAME TO message_classes;
+
+-- messages.browse: the ads of one class, newest first
+CREATE INDEX message_classes_class_idx ON message_classes (class_id, message_id);
+
+-- Number of ads per class, kept up to date by the triggers below so that
+-- facet counts are read from one row per class.
+CREATE TABLE class_counts (
+    class_id INTEGER PRIMARY KEY,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY(class_id) REFERENCES classes(id)
+);
+
+INSERT INTO class_counts (class_id, message_count)
+SELECT c.id, (SELECT COUNT(*) FROM message_classes mc WHERE mc.class_id = c.id)
+FROM classes c;
+
+CREATE TRIGGER message_classes_count_insert AFTER INSERT ON message_classes BEGIN
+    UPDATE class_counts SET message_count = message_count + 1 WHERE class_id = new.class_id;
+END;
+
+CREATE TRIGGER message_classes_count_delete AFTER DELETE ON message_classes BEGIN
+    UPDATE class_counts SET message_count = message_count - 1 WHERE class_id = old.class_id;
+END;
+
+CREATE TRIGGER classes_count_insert AFTER INSERT ON classes BEGIN
+    INSERT INTO class_counts (class_id) VALUES (new.id);
+END;
+
+CREATE TRIGGER classes_count_delete BEFORE DELETE ON classes BEGIN
+    DELETE FROM class_counts WHERE class_id = old.id;
+END;
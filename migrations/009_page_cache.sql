@@ -0,0 +1,32 @@
+-- A counter bumped by every write that changes what the cached pages show.
+-- Together with MAX(messages.id) it versions the rendered page cache.
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    counter INTEGER NOT NULL
+);
+
+INSERT OR IGNORE INTO data_version (id, counter) VALUES (1, 0);
+
+CREATE TRIGGER IF NOT EXISTS messages_version_insert AFTER INSERT ON messages BEGIN
+    UPDATE data_version SET counter = counter + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_version_update AFTER UPDATE ON messages BEGIN
+    UPDATE data_version SET counter = counter + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_version_delete AFTER DELETE ON messages BEGIN
+    UPDATE data_version SET counter = counter + 1 WHERE id = 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_version_update
+AFTER UPDATE OF username, age, bio, image_hash ON users BEGIN
+    UPDATE data_version SET counter = counter + 1 WHERE id = 1;
+END;
+
+-- Rendered pages shared by all worker processes when PAGE_CACHE=sqlite.
+CREATE TABLE IF NOT EXISTS page_cache (
+    key TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    body TEXT NOT NULL
+) WITHOUT ROWID;
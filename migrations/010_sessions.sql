@@ -0,0 +1,9 @@
+-- Server-side session store, used when SESSION_STORE=sqlite.
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at INTEGER NOT NULL
+) WITHOUT ROWID;
+
+-- sessions.purge_expired_sessions
+CREATE INDEX IF NOT EXISTS sessions_expires_idx ON sessions (expires_at);
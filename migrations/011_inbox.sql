@@ -0,0 +1,41 @@
+-- Inbox projection: each participant row also carries what /threads shows
+-- (partner name, ad title, last message and last activity), so the inbox is
+-- one range scan of the user's rows in activity order without any joins.
+ALTER TABLE thread_participants ADD COLUMN partner_name TEXT NOT NULL DEFAULT '';
+ALTER TABLE thread_participants ADD COLUMN ad_title TEXT NOT NULL DEFAULT '';
+ALTER TABLE thread_participants ADD COLUMN last_message TEXT;
+ALTER TABLE thread_participants ADD COLUMN last_activity TEXT NOT NULL DEFAULT '';
+
+UPDATE thread_participants
+SET partner_name = u.username,
+    ad_title = m.title,
+    last_activity = t.created_at
+FROM threads t
+JOIN messages m ON m.id = t.ad_id
+JOIN users u ON u.id IN (t.user1_id, t.user2_id)
+WHERE t.id = thread_participants.thread_id AND u.id != thread_participants.user_id;
+
+UPDATE thread_participants
+SET last_message = substr(tm.content, 1, 100),
+    last_activity = tm.created_at
+FROM (SELECT thread_id, MAX(id) AS id FROM thread_messages GROUP BY thread_id) latest
+JOIN thread_messages tm ON tm.id = latest.id
+WHERE latest.thread_id = thread_participants.thread_id;
+
+-- threads.get_user_threads: user_id = ? ORDER BY last_activity DESC, thread_id DESC
+CREATE INDEX IF NOT EXISTS thread_participants_inbox_idx
+    ON thread_participants (user_id, last_activity, thread_id);
+
+-- Renames are rare, so they are copied into the inbox rows by triggers.
+CREATE TRIGGER IF NOT EXISTS messages_inbox_title
+AFTER UPDATE OF title ON messages WHEN NEW.title != OLD.title BEGIN
+    UPDATE thread_participants SET ad_title = NEW.title
+    WHERE thread_id IN (SELECT id FROM threads WHERE ad_id = NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_inbox_username
+AFTER UPDATE OF username ON users WHEN NEW.username != OLD.username BEGIN
+    UPDATE thread_participants SET partner_name = NEW.username
+    WHERE user_id != NEW.id
+      AND thread_id IN (SELECT id FROM threads WHERE user1_id = NEW.id OR user2_id = NEW.id);
+END;
@@ -0,0 +1,49 @@
+-- A thread is identified by its ad and the unordered pair of participants.
+-- The canonical (ad_id, user_low, user_high) key is unique, so concurrent
+-- starts of the same conversation cannot create two threads.
+ALTER TABLE threads ADD COLUMN user_low INTEGER AS (min(user1_id, user2_id));
+ALTER TABLE threads ADD COLUMN user_high INTEGER AS (max(user1_id, user2_id));
+
+-- Merge existing duplicates into the oldest thread of each key.
+CREATE TEMP TABLE thread_merges AS
+SELECT t.id AS duplicate_id, k.keeper_id
+FROM threads t
+JOIN (SELECT ad_id, user_low, user_high, MIN(id) AS keeper_id
+      FROM threads
+      GROUP BY ad_id, user_low, user_high
+      HAVING COUNT(*) > 1) k
+  ON k.ad_id = t.ad_id AND k.user_low = t.user_low AND k.user_high = t.user_high
+WHERE t.id != k.keeper_id;
+
+UPDATE thread_messages
+SET thread_id = (SELECT keeper_id FROM thread_merges WHERE duplicate_id = thread_messages.thread_id)
+WHERE thread_id IN (SELECT duplicate_id FROM thread_merges);
+
+UPDATE thread_participants
+SET unread_count = thread_participants.unread_count + d.unread_count,
+    last_read_id = max(thread_participants.last_read_id, d.last_read_id),
+    last_message = CASE WHEN d.last_activity > thread_participants.last_activity
+                        THEN d.last_message ELSE thread_participants.last_message END,
+    last_activity = max(thread_participants.last_activity, d.last_activity)
+FROM (SELECT m.keeper_id, p.user_id,
+             SUM(p.unread_count) AS unread_count,
+             MAX(p.last_read_id) AS last_read_id,
+             MAX(p.last_activity) AS last_activity,
+             (SELECT latest.last_message
+              FROM thread_merges lm
+              JOIN thread_participants latest ON latest.thread_id = lm.duplicate_id
+              WHERE lm.keeper_id = m.keeper_id AND latest.user_id = p.user_id
+              ORDER BY latest.last_activity DESC, latest.thread_id DESC
+              LIMIT 1) AS last_message
+      FROM thread_merges m
+      JOIN thread_participants p ON p.thread_id = m.duplicate_id
+      GROUP BY m.keeper_id, p.user_id) d
+WHERE thread_participants.thread_id = d.keeper_id AND thread_participants.user_id = d.user_id;
+
+DELETE FROM thread_participants WHERE thread_id IN (SELECT duplicate_id FROM thread_merges);
+DELETE FROM threads WHERE id IN (SELECT duplicate_id FROM thread_merges);
+DROP TABLE thread_merges;
+
+-- Also serves ad_id = ? lookups, so the single-column index is redundant.
+CREATE UNIQUE INDEX IF NOT EXISTS threads_pair_idx ON threads (ad_id, user_low, user_high);
+DROP INDEX IF EXISTS threads_ad_idx;
@@ -0,0 +1,40 @@
+-- Persistent background jobs. A job with a key is queued at most once at a
+-- time; finished jobs are deleted and failed ones kept for inspection.
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    key TEXT UNIQUE,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    locked_until REAL,
+    last_error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- jobs.claim: the oldest due job
+CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (run_at) WHERE state = 'queued';
+-- jobs.requeue_expired: running jobs whose worker has gone away
+CREATE INDEX IF NOT EXISTS jobs_running_idx ON jobs (locked_until) WHERE state = 'running';
+
+-- A removed ad is hidden at once and deleted later by a purge job.
+ALTER TABLE messages ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0;
+
+-- jobs.cleanup: removed ads whose purge has not finished
+CREATE INDEX IF NOT EXISTS messages_deleted_idx ON messages (id) WHERE deleted = 1;
+
+-- Facet counts only include visible ads: hiding an ad takes its classes out
+-- of the counts, so deleting its class rows later must not do it again.
+CREATE TRIGGER IF NOT EXISTS messages_deleted_counts
+AFTER UPDATE OF deleted ON messages WHEN NEW.deleted != OLD.deleted BEGIN
+    UPDATE class_counts
+    SET message_count = message_count + CASE WHEN NEW.deleted THEN -1 ELSE 1 END
+    WHERE class_id IN (SELECT class_id FROM message_classes WHERE message_id = NEW.id);
+END;
+
+DROP TRIGGER IF EXISTS message_classes_count_delete;
+CREATE TRIGGER message_classes_count_delete AFTER DELETE ON message_classes
+WHEN NOT EXISTS (SELECT 1 FROM messages WHERE id = old.message_id AND deleted = 1) BEGIN
+    UPDATE class_counts SET message_count = message_count - 1 WHERE class_id = old.class_id;
+END;
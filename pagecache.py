@@ -0,0 +1,160 @@
+"""
+Rendered page and fragment cache for the public pages.
+
+Entries are keyed by the data version: the newest message id together with
+the data_version counter, which triggers bump on every write that changes
+what the pages show. A write therefore retires every cached page at once and
+nothing has to be invalidated by hand.
+
+Anonymous visitors get whole pages from the cache, with an ETag derived from
+the version so that repeat visits are answered with 304 Not Modified without
+rendering anything. Logged-in users get the shared ad lists as cached
+fragments inside their personal page. PAGE_CACHE selects the backend:
+"memory" (per process), "sqlite" (shared by all workers) or "off".
+"""
+
+import hashlib
+import os
+
+from flask import g, make_response, request
+from markupsafe import Markup
+
+import cache
+import config
+import db
+import writer
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+def _templates_version():
+    """The newest template modification time, so that a deploy retires old pages."""
+    mtimes = [entry.stat().st_mtime_ns for entry in os.scandir(TEMPLATE_DIR)]
+    return str(max(mtimes, default=0))
+
+
+DEPLOY_VERSION = _templates_version()
+
+
+class MemoryPageStore:
+    """Pages kept in an LRU cache of the current process."""
+
+    def __init__(self):
+        self._cache = cache.LRUCache(maxsize=config.page_cache_size)
+        cache.caches["pages"] = self._cache
+
+    def get(self, key, version):
+        """Return the cached body, or None."""
+        if not cache.enabled:
+            return None
+        value = self._cache.get((key, version))
+        return None if value is cache.MISSING else value
+
+    def set(self, key, version, body):
+        """Store a rendered body."""
+        self._cache.set((key, version), body)
+
+
+class SQLitePageStore:
+    """Pages kept in the page_cache table, shared by every worker process."""
+
+    def __init__(self):
+        self._pruned_version = None
+
+    def get(self, key, version):
+        """Return the cached body, or None."""
+        rows = db.query("SELECT body FROM page_cache WHERE key = ? AND version = ?",
+                        [key, version])
+        return rows[0]["body"] if rows else None
+
+    def set(self, key, version, body):
+        """Store a rendered body through the writer, dropping older versions once."""
+        sql = "INSERT OR REPLACE INTO page_cache (key, version, body) VALUES (?, ?, ?)"
+        writer.submit(db.execute, sql, [key, version, body])
+        if self._pruned_version != version:
+            self._pruned_version = version
+            writer.submit(db.execute, "DELETE FROM page_cache WHERE version != ?", [version])
+
+
+class NullPageStore:
+    """Caching turned off."""
+
+    def get(self, key, version):  # pylint: disable=unused-argument
+        """Nothing is cached."""
+        return None
+
+    def set(self, key, version, body):
+        """Nothing is cached."""
+
+
+STORES = {
+    "memory": MemoryPageStore,
+    "sqlite": SQLitePageStore,
+    "off": NullPageStore,
+}
+
+_store = None
+
+
+def get_store():
+    """Return the page store selected by config.page_cache."""
+    global _store  # pylint: disable=global-statement
+    if _store is None:
+        _store = STORES[config.page_cache]()
+    return _store
+
+
+def data_version():
+    """Return the data version of the current request, read once per request."""
+    if "data_version" not in g:
+        row = db.query(
+            "SELECT (SELECT MAX(id) FROM messages), counter FROM data_version WHERE id = 1"
+        )[0]
+        g.data_version = f"{DEPLOY_VERSION}.{row[0] or 0}.{row[1]}"
+    return g.data_version
+
+
+def fragment(name, render, *key):
+    """
+    Return the cached HTML of a fragment, rendering it with render() on a
+    miss. The key arguments identify the fragment within its name. If
+    render() returns None, nothing is cached and None is returned.
+    """
+    store = get_store()
+    version = data_version()
+    cache_key = ":".join(["fragment", name, *map(str, key)])
+    body = store.get(cache_key, version)
+    if body is None:
+        body = render()
+        if body is None:
+            return None
+        store.set(cache_key, version, str(body))
+    return Markup(body)
+
+
+def page(render, *key):
+    """
+    Serve the page of the current path from the cache. The key arguments are
+    the query parameters the page reads, so that other query strings share
+    its entry. Answers 304 when the client already has the current version,
+    otherwise renders with render() on a miss. A response returned by
+    render(), such as a redirect, is passed through uncached.
+    """
+    version = data_version()
+    cache_key = ":".join(["page", request.path, *map(str, key)])
+    etag = hashlib.sha1(f"{cache_key}:{version}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        store = get_store()
+        body = store.get(cache_key, version)
+        if body is None:
+            body = render()
+            if not isinstance(body, str):
+                return body
+            store.set(cache_key, version, body)
+        response = make_response(body)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
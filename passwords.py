@@ -0,0 +1,175 @@
+"""
+Password hashing off the request threads, with back-pressure and throttling.
+
+Hashes are computed and checked in a process pool with PASSWORD_WORKERS
+processes (by default one per core), so a burst of logins cannot starve the
+other routes of the worker. At most PASSWORD_QUEUE_DEPTH hashing jobs may be
+queued or running; beyond that Overloaded is raised and the client gets 503
+with Retry-After. Login attempts are throttled per client address and failed
+logins per username before any hashing is done. The limits are kept per
+process.
+
+Hashes made with another method or cost than PASSWORD_METHOD are replaced
+in the background after a successful login.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import config
+import db
+import writer
+
+RESULT_TIMEOUT = 30
+
+
+class Overloaded(Exception):
+    """Raised when the hashing queue is full."""
+
+
+class RateLimiter:
+    """Sliding-window event counts per key, for a bounded number of keys."""
+
+    def __init__(self, limit, window, maxsize=10000):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._events = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        events = self._events.get(key)
+        if events is None:
+            return None
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        return events
+
+    def allowed(self, key):
+        """Return True if the key is below its limit."""
+        with self._lock:
+            events = self._recent(key, time.monotonic())
+            return events is None or len(events) < self.limit
+
+    def _add(self, key, now):
+        events = self._recent(key, now)
+        if events is None:
+            events = self._events[key] = deque()
+        events.append(now)
+        self._events.move_to_end(key)
+        while len(self._events) > self.maxsize:
+            self._events.popitem(last=False)
+
+    def add(self, key):
+        """Record one event for the key."""
+        with self._lock:
+            self._add(key, time.monotonic())
+
+    def hit(self, key):
+        """Record an event and return True if the key was below its limit."""
+        with self._lock:
+            now = time.monotonic()
+            events = self._recent(key, now)
+            if events is not None and len(events) >= self.limit:
+                return False
+            self._add(key, now)
+            return True
+
+    def reset(self, key):
+        """Forget the events of the key."""
+        with self._lock:
+            self._events.pop(key, None)
+
+
+attempts_by_address = RateLimiter(config.login_address_limit, config.login_window)
+failures_by_username = RateLimiter(config.login_username_limit, config.login_window)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(config.password_queue_depth)
+
+
+def _get_executor(broken=None):
+    """Return the pool of this process, replacing it if it is the broken one."""
+    global _executor, _executor_pid  # pylint: disable=global-statement
+    with _executor_lock:
+        if broken is not None and _executor is broken:
+            broken.shutdown(wait=False)
+            _executor = None
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=config.password_workers or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _submit(func, *args):
+    """Queue a hashing job, or raise Overloaded if the queue is full."""
+    if not _slots.acquire(blocking=False):
+        raise Overloaded()
+    try:
+        executor = _get_executor()
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            future = _get_executor(broken=executor).submit(func, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def hash_password(password):
+    """Return a hash of the password made with PASSWORD_METHOD."""
+    return _submit(generate_password_hash, password, config.password_method).result(
+        timeout=RESULT_TIMEOUT
+    )
+
+
+def verify_password(password_hash, password):
+    """Return True if the password matches the hash."""
+    return _submit(check_password_hash, password_hash, password).result(timeout=RESULT_TIMEOUT)
+
+
+# The method prefix, e.g. "scrypt:32768:8:1", of hashes made now.
+CURRENT_METHOD = generate_password_hash("", config.password_method).split("$", 1)[0]
+
+
+def needs_rehash(password_hash):
+    """Return True if the hash was made with another method or cost."""
+    return password_hash.split("$", 1)[0] != CURRENT_METHOD
+
+
+def rehash_later(user_id, password):
+    """Replace the user's password hash in the background; skipped when busy."""
+    try:
+        future = _submit(generate_password_hash, password, config.password_method)
+    except Overloaded:
+        return
+
+    def store(done):
+        if done.exception() is None:
+            sql = "UPDATE users SET password_hash = ? WHERE id = ?"
+            writer.submit(db.execute, sql, [done.result(), user_id])
+    future.add_done_callback(store)
+
+
+def overloaded(error):  # pylint: disable=unused-argument
+    """Answers 503 with Retry-After when the hashing queue is full."""
+    return "Palvelu on ruuhkautunut, yritä hetken kuluttua uudelleen.", 503, {"Retry-After": "1"}
+
+
+def init_app(app):
+    """Registers the 503 response for a full hashing queue."""
+    app.register_error_handler(Overloaded, overloaded)
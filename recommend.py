@@ -0,0 +1,258 @@
+"""
+"Suggested for you" ads ranked by shared classes and age proximity.
+
+Every ad is encoded in NumPy arrays: its classes as a bit vector, its age and
+its owner. The arrays are built once per process in a background thread, and
+no suggestions are made until the build is done. They are kept up to date by
+refresh_ad(), which the write paths call after committing. Writes made by
+other worker processes are picked up by a background rebuild at most every
+RECOMMEND_REBUILD_INTERVAL seconds after the data version has moved.
+
+The viewer's interests are the classes of their own ads. Scoring is one
+vectorised pass over the corpus: the number of shared classes plus an age
+term that falls from 1 to 0 over AGE_RANGE years, with ties going to newer
+ads, and the top k are chosen with argpartition. Results are cached per
+viewer until the index changes. Without NumPy no suggestions are made.
+"""
+
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is optional
+    np = None
+
+import cache
+import config
+import db
+
+SUGGESTIONS = 5
+AGE_RANGE = 20
+CAPACITY = 1024
+
+_BYTE_BITS = None if np is None else np.array(
+    [bin(byte).count("1") for byte in range(256)], dtype=np.uint8
+)
+
+
+def bit_count(words):
+    """Return the number of set bits of each uint64 word."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    # NumPy 1.x: count the bits of each byte from a lookup table.
+    words = np.ascontiguousarray(words)
+    return _BYTE_BITS[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1)
+
+
+_results = cache.LRUCache(maxsize=4096, ttl=config.recommend_ttl)
+cache.caches["recommendations"] = _results
+
+
+class AdIndex:
+    """Class bit vectors, ages and owners of all ads, ordered by ad id."""
+
+    def __init__(self, class_ids):
+        self.bit_of = {class_id: bit for bit, class_id in enumerate(class_ids)}
+        self.words = max(1, (len(class_ids) + 63) // 64)
+        self.size = 0
+        self.version = 0
+        self.ids = np.zeros(CAPACITY, dtype=np.int64)
+        self.bits = np.zeros((CAPACITY, self.words), dtype=np.uint64)
+        self.ages = np.zeros(CAPACITY, dtype=np.float32)
+        self.owners = np.zeros(CAPACITY, dtype=np.int64)
+        self.alive = np.zeros(CAPACITY, dtype=bool)
+        self.lock = threading.Lock()
+
+    def encode(self, class_ids):
+        """Return the bit vector of a set of class ids."""
+        vector = np.zeros(self.words, dtype=np.uint64)
+        for class_id in class_ids:
+            bit = self.bit_of.get(class_id)
+            if bit is not None:
+                vector[bit // 64] |= np.uint64(1 << (bit % 64))
+        return vector
+
+    def _grow(self, needed):
+        capacity = len(self.ids)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("ids", "ages", "owners", "alive"):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        bits = np.zeros((capacity, self.words), dtype=np.uint64)
+        bits[:len(self.bits)] = self.bits
+        self.bits = bits
+
+    def load(self, ads, ad_classes):
+        """Fill the index from (id, age, user_id) rows ordered by id and (ad id, class id) rows."""
+        ads = np.array(ads, dtype=np.int64).reshape(-1, 3)
+        self._grow(len(ads))
+        self.size = len(ads)
+        self.ids[:self.size] = ads[:, 0]
+        self.ages[:self.size] = ads[:, 1]
+        self.owners[:self.size] = ads[:, 2]
+        self.alive[:self.size] = True
+
+        pairs = np.array(
+            [(ad_id, self.bit_of[class_id]) for ad_id, class_id in ad_classes
+             if class_id in self.bit_of],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        rows = np.searchsorted(self.ids[:self.size], pairs[:, 0])
+        found = (rows < self.size) & (self.ids[np.minimum(rows, self.size - 1)] == pairs[:, 0])
+        rows, bits = rows[found], pairs[found, 1]
+        masks = np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64))
+        np.bitwise_or.at(self.bits, (rows, bits // 64), masks)
+        self.version += 1
+
+    def _position(self, message_id):
+        row = int(np.searchsorted(self.ids[:self.size], message_id))
+        if row < self.size and self.ids[row] == message_id:
+            return row
+        return None
+
+    def upsert(self, message_id, age, user_id, class_ids):
+        """Add an ad or replace its data."""
+        with self.lock:
+            row = self._position(message_id)
+            if row is None:
+                if self.size and message_id < self.ids[self.size - 1]:
+                    return
+                self._grow(self.size + 1)
+                row = self.size
+                self.size += 1
+                self.ids[row] = message_id
+            self.ages[row] = age
+            self.owners[row] = user_id
+            self.bits[row] = self.encode(class_ids)
+            self.alive[row] = True
+            self.version += 1
+
+    def remove(self, message_id):
+        """Drop an ad from the suggestions."""
+        with self.lock:
+            row = self._position(message_id)
+            if row is not None:
+                self.alive[row] = False
+                self.version += 1
+
+    def top_k(self, viewer_id, viewer_age, k=SUGGESTIONS):
+        """Return the ids of the k best ads for a viewer, best first."""
+        with self.lock:
+            size = self.size
+            if not size:
+                return []
+            bits = self.bits[:size]
+            alive = self.alive[:size]
+            own = self.owners[:size] == viewer_id
+            interests = np.bitwise_or.reduce(bits[own & alive], axis=0)
+
+            scores = bit_count(bits & interests).sum(axis=1, dtype=np.float64)
+            if viewer_age is not None:
+                distance = np.abs(self.ages[:size] - viewer_age)
+                scores += np.clip(1 - distance / AGE_RANGE, 0, 1)
+            # Ties go to newer ads; the term stays below one year of age difference.
+            scores += np.arange(size) / size / (2 * AGE_RANGE)
+            scores[own | ~alive] = -np.inf
+
+            k = min(k, int(np.isfinite(scores).sum()))
+            if k <= 0:
+                return []
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best], kind="stable")]
+            return [int(message_id) for message_id in self.ids[best]]
+
+
+_index = None
+_index_lock = threading.Lock()
+_synced_version = None
+_checked_at = 0.0
+_rebuilding = False
+
+
+def data_version():
+    """Return the data_version counter, which every write to the ads bumps."""
+    return db.query("SELECT counter FROM data_version WHERE id = 1")[0][0]
+
+
+def build_index():
+    """Read every ad and its classes into a new index."""
+    class_ids = [row[0] for row in db.query("SELECT id FROM classes ORDER BY id")]
+    index = AdIndex(class_ids)
+    version = data_version()
+    ads = db.query("SELECT id, age, user_id FROM messages WHERE deleted = 0 ORDER BY id")
+    ad_classes = db.query("SELECT message_id, class_id FROM message_classes")
+    index.load([tuple(row) for row in ads], [tuple(row) for row in ad_classes])
+    return index, version
+
+
+def _rebuild_in_background():
+    global _index, _synced_version, _rebuilding  # pylint: disable=global-statement
+    try:
+        index, version = build_index()
+        with _index_lock:
+            _index, _synced_version = index, version
+    finally:
+        db.close_connection()
+        _rebuilding = False
+
+
+def get_index():
+    """
+    Return the index, or None until its first build is done. The index is
+    built in the background on first use and rebuilt there when stale.
+    """
+    global _checked_at, _rebuilding  # pylint: disable=global-statement
+    with _index_lock:
+        stale = time.monotonic() - _checked_at > config.recommend_rebuild_interval
+        if not _rebuilding and (_index is None or stale):
+            _checked_at = time.monotonic()
+            if _index is None or data_version() != _synced_version:
+                _rebuilding = True
+                threading.Thread(target=_rebuild_in_background, daemon=True).start()
+        return _index
+
+
+def refresh_ad(message_id, version_before, version_after):
+    """
+    Re-read one ad into the index after it was added, changed or removed.
+    The versions are read in the transaction of the write, before and after
+    it. If the index was synced up to the write, it counts as synced after
+    it, so that this process's own writes do not cause a rebuild; writes of
+    other processes in between leave it stale for the background rebuild.
+    """
+    global _synced_version  # pylint: disable=global-statement
+    if np is None or _index is None:
+        return
+    sql = "SELECT age, user_id FROM messages WHERE id = ? AND deleted = 0"
+    rows = db.query(sql, [message_id])
+    if not rows:
+        _index.remove(message_id)
+    else:
+        class_ids = [row[0] for row in db.query(
+            "SELECT class_id FROM message_classes WHERE message_id = ?", [message_id]
+        )]
+        _index.upsert(message_id, rows[0]["age"], rows[0]["user_id"], class_ids)
+    with _index_lock:
+        if not _rebuilding and _synced_version == version_before:
+            _synced_version = version_after
+
+
+def suggestions(viewer_id, viewer_age, k=SUGGESTIONS):
+    """Return the ids of the ads suggested to a viewer, best first."""
+    if np is None:
+        return []
+    index = get_index()
+    if index is None:
+        return []
+    key = (viewer_id, viewer_age, k, id(index), index.version)
+    found = _results.get(key)
+    if found is cache.MISSING:
+        found = index.top_k(viewer_id, viewer_age, k)
+        _results.set(key, found)
+    return found
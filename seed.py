@@ -1,60 +1,233 @@
 """
 Seed script for Friend App.
-Creates test data for performance testing: users, threads, and messages.
+
+Generates synthetic data for load and performance testing: users, ads with
+classes, threads and chat messages. Rows are streamed into bulk executemany
+inserts inside a single transaction, every user shares one precomputed
+password hash, and the output is deterministic for a given --seed.
+
+Usage:
+    python seed.py --scale 1000
+    python seed.py --users 10000 --ads 50000 --threads 200000 --messages 2000000
+
+All generated users have the password "test123". The existing users, ads
+and threads are deleted first.
 """
 
+import argparse
+import array
+import datetime
+import itertools
 import random
-import sqlite3
+import time
+
 from werkzeug.security import generate_password_hash
 
-db = sqlite3.connect("database.db")
-
-db.execute("DELETE FROM users")
-db.execute("DELETE FROM threads")
-db.execute("DELETE FROM messages")
-
-user_count = 10
-thread_count = 20
-message_count = 50
-
-print("Creating users...")
-password = "test123" 
-for i in range(1, user_count + 1):
-    password_hash = generate_password_hash(password)
-    db.execute(
-        "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-        [f"user{i}", password_hash]
-    )
-db.commit()
-
-print("Creating threads...")
-for i in range(1, thread_count + 1):
-    user1_id = random.randint(1, user_count)
-    user2_id = random.randint(1, user_count)
-    while user2_id == user1_id:
-        user2_id = random.randint(1, user_count)
-    ad_id = random.randint(1, message_count) 
-    db.execute(
-        "INSERT INTO threads (ad_id, user1_id, user2_id) VALUES (?, ?, ?)",
-        [ad_id, user1_id, user2_id]
-    )
-db.commit()
-
-print("Creating messages...")
-for i in range(1, message_count + 1):
-    user1_id = random.randint(1, user_count)
-    user2_id = random.randint(1, user_count)
-    while user2_id == user1_id:
-        user2_id = random.randint(1, user_count)
-    ad_id = random.randint(1, 10)  
-    db.execute(
-        "INSERT INTO threads (ad_id, user1_id, user2_id) VALUES (?, ?, ?)",
-        [ad_id, user1_id, user2_id]
-    )
-db.commit()
- 
-db.commit()
-db.close()
-print("Seeding complete!")
+import db
+
+PASSWORD = "test123"
+
+TITLE_WORDS = [
+    "Etsin", "Seuraa", "Kaveria", "Lenkkiseuraa", "Elokuvaseuraa", "Pelikaveria",
+    "Kokkauskaveria", "Lukupiiriin", "Kahvittelemaan", "Retkelle", "Konserttiin",
+    "Salille", "viikonloppuna", "Helsingissä", "Tampereella", "Turussa", "Oulussa",
+]
+DESCRIPTION_SENTENCES = [
+    "Haluan tutustua uusiin ihmisiin.",
+    "Käyn mielelläni lenkillä ja salilla.",
+    "Pidän elokuvista ja hyvästä ruoasta.",
+    "Pelaan videopelejä iltaisin.",
+    "Luen paljon dekkareita ja tietokirjoja.",
+    "Olen muuttanut kaupunkiin hiljattain.",
+    "Etsin seuraa kahville tai kävelylle.",
+    "Tykkään käydä konserteissa ja teatterissa.",
+    "Viikonloppuisin retkeilen luonnossa.",
+    "Kokkaan mielelläni isommallekin porukalle.",
+]
+CHAT_LINES = [
+    "Moi!", "Hei, näin ilmoituksesi.", "Kuulostaa kivalta!", "Milloin sinulle sopisi?",
+    "Lauantai käy hyvin.", "Missä päin asut?", "Kiitos viestistä!", "Nähdään sitten!",
+    "Mitä harrastat?", "Olisin kiinnostunut.", "Sopiiko ensi viikko?", "Hyvä idea!",
+]
+
+BATCH_SIZE = 10_000
+
+
+def scaled_counts(scale):
+    """Return the default row counts for a scale given as the number of users."""
+    return {
+        "users": scale,
+        "ads": scale * 3,
+        "threads": scale * 5,
+        "messages": scale * 40,
+    }
+
+
+def skewed_weights(rng, count, alpha=1.2):
+    """Return cumulative Pareto weights, so that a few rows are very popular."""
+    return array.array("d", itertools.accumulate(rng.paretovariate(alpha) for _ in range(count)))
+
+
+def skewed_picks(rng, cum_weights, count):
+    """Yield count ids from 1..len(cum_weights), drawn with the given weights."""
+    population = range(1, len(cum_weights) + 1)
+    for offset in range(0, count, BATCH_SIZE):
+        yield from rng.choices(population, cum_weights=cum_weights,
+                               k=min(BATCH_SIZE, count - offset))
+
+
+def batched(rows):
+    """Split a row iterator into lists of BATCH_SIZE rows."""
+    iterator = iter(rows)
+    while batch := list(itertools.islice(iterator, BATCH_SIZE)):
+        yield batch
+
+
+def insert(con, sql, rows):
+    """Bulk insert rows from an iterator and return how many were inserted."""
+    total = 0
+    for batch in batched(rows):
+        con.executemany(sql, batch)
+        total += len(batch)
+    return total
+
+
+def clear(con):
+    """Delete the generated tables and restart their ids from 1."""
+    for table in ["thread_participants", "thread_messages", "threads",
+                  "message_classes", "messages", "users"]:
+        con.execute(f"DELETE FROM {table}")
+    con.execute("DELETE FROM sqlite_sequence WHERE name IN "
+                "('thread_messages', 'threads', 'messages', 'users')")
+
+
+def seed(con, counts, rng):
+    """Generate all rows. Ids are contiguous from 1 because the tables are cleared."""
+    user_count = counts["users"]
+    ad_count = counts["ads"]
+    thread_count = counts["threads"]
+    message_count = counts["messages"]
+
+    print("Creating users...")
+    password_hash = generate_password_hash(PASSWORD)
+    ages = [min(max(int(rng.triangular(16, 75, 27)), 16), 90) for _ in range(user_count)]
+    insert(con, "INSERT INTO users (username, password_hash, age, bio) VALUES (?, ?, ?, ?)", (
+        (f"user{i + 1}", password_hash, ages[i], rng.choice(DESCRIPTION_SENTENCES))
+        for i in range(user_count)
+    ))
+
+    print("Creating ads...")
+    authors = array.array("l", skewed_picks(rng, skewed_weights(rng, user_count), ad_count))
+    insert(con, "INSERT INTO messages (title, description, age, user_id) VALUES (?, ?, ?, ?)", (
+        (
+            " ".join(rng.sample(TITLE_WORDS, 3)),
+            " ".join(rng.sample(DESCRIPTION_SENTENCES, rng.randint(1, 4))),
+            ages[author - 1],
+            author,
+        )
+        for author in authors
+    ))
+
+    print("Creating ad classes...")
+    classes = {}
+    for class_id, title in con.execute("SELECT id, title FROM classes ORDER BY id"):
+        classes.setdefault(title, []).append(class_id)
+
+    def ad_classes():
+        for ad_id in range(1, ad_count + 1):
+            for class_ids in classes.values():
+                if rng.random() < 0.7:
+                    yield (ad_id, rng.choice(class_ids))
+    insert(con, "INSERT INTO message_classes (message_id, class_id) VALUES (?, ?)", ad_classes())
+
+    print("Creating threads...")
+    ad_weights = skewed_weights(rng, ad_count)
+
+    def thread_rows():
+        for ad_id in skewed_picks(rng, ad_weights, thread_count):
+            owner_id = authors[ad_id - 1]
+            user_id = rng.randint(1, user_count)
+            while user_id == owner_id and user_count > 1:
+                user_id = rng.randint(1, user_count)
+            yield (ad_id, user_id, owner_id)
+    # A user has one thread per ad; the unique pair key drops the repeats.
+    insert(con, "INSERT OR IGNORE INTO threads (ad_id, user1_id, user2_id) VALUES (?, ?, ?)",
+           thread_rows())
+    # Ignored rows still use up ids, so the thread ids are read back.
+    thread_ids = array.array("l")
+    user1_ids = array.array("l")
+    user2_ids = array.array("l")
+    for thread_id, user1_id, user2_id in con.execute(
+            "SELECT id, user1_id, user2_id FROM threads ORDER BY id"):
+        thread_ids.append(thread_id)
+        user1_ids.append(user1_id)
+        user2_ids.append(user2_id)
+    thread_count = counts["threads"] = len(thread_ids)
+
+    print("Creating chat messages...")
+    thread_weights = skewed_weights(rng, thread_count)
+    start = datetime.datetime(2024, 1, 1)
+
+    def chat_rows():
+        picks = skewed_picks(rng, thread_weights, message_count)
+        for i, pick in enumerate(picks):
+            row = pick - 1
+            sender_id = user1_ids[row] if rng.random() < 0.5 else user2_ids[row]
+            created_at = start + datetime.timedelta(seconds=i * 7)
+            yield (thread_ids[row], sender_id, rng.choice(CHAT_LINES), created_at.isoformat(" "),
+                   1 if rng.random() < 0.9 else 0)
+    insert(con, """
+        INSERT INTO thread_messages (thread_id, sender_id, content, created_at, read_by_user)
+        VALUES (?, ?, ?, ?, ?)
+    """, chat_rows() if thread_count else ())
+
+    print("Computing read state and inboxes...")
+    con.execute("""
+    INSERT INTO thread_participants (thread_id, user_id, last_read_id, unread_count,
+                                     partner_name, ad_title, last_message, last_activity)
+    SELECT p.id, p.user_id,
+           COALESCE((SELECT MAX(tm.id) FROM thread_messages tm
+                     WHERE tm.thread_id = p.id
+                       AND (tm.sender_id = p.user_id OR tm.read_by_user = 1)), 0),
+           (SELECT COUNT(*) FROM thread_messages tm
+            WHERE tm.thread_id = p.id AND tm.sender_id != p.user_id AND tm.read_by_user = 0),
+           u.username, m.title, substr(tm.content, 1, 100),
+           COALESCE(tm.created_at, t.created_at)
+    FROM (SELECT id, user1_id AS user_id, user2_id AS partner_id FROM threads
+          UNION
+          SELECT id, user2_id AS user_id, user1_id AS partner_id FROM threads) p
+    JOIN threads t ON t.id = p.id
+    JOIN users u ON u.id = p.partner_id
+    JOIN messages m ON m.id = t.ad_id
+    LEFT JOIN thread_messages tm
+        ON tm.id = (SELECT MAX(id) FROM thread_messages WHERE thread_id = p.id)
+    """)
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=100,
+                        help="number of users; the other counts default relative to it")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--ads", type=int)
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--messages", type=int)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    counts = scaled_counts(args.scale)
+    for name in counts:
+        if getattr(args, name) is not None:
+            counts[name] = getattr(args, name)
+
+    started = time.perf_counter()
+    with db.transaction() as con:
+        clear(con)
+        seed(con, counts, random.Random(args.seed))
+    print(f"Seeding complete in {time.perf_counter() - started:.1f} s: {counts}")
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Session and CSRF handling for the Friend App.
+
+CSRF tokens are stateless: a token is a timestamp and an HMAC of it and the
+logged-in user id under the secret key, so issuing or checking one never
+writes to the session. Tokens are checked on every unsafe method together
+with the Origin header, and expire after CSRF_TOKEN_TTL seconds. Anonymous
+tokens are the same for every visitor, so anonymous forms such as login and
+registration must also come with an Origin or Referer of this site.
+
+Requests for static files and profile images get no session at all, and a
+session that is only read is never written back, so anonymous pages, static
+files and images are served without Set-Cookie and can be cached by proxies.
+With SESSION_STORE=sqlite the cookie only carries a random session id and
+the data is kept in the sessions table.
+"""
+
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from urllib.parse import urlparse
+
+from flask import abort, g, request, session
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface, SessionInterface
+
+import config
+import db
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+SESSIONLESS_PATHS = ("/static/", "/image/")
+
+
+def _signature(binding, timestamp):
+    message = f"{binding}:{timestamp}".encode()
+    return hmac.new(config.secret_key.encode(), message, hashlib.sha256).hexdigest()
+
+
+def _binding():
+    return str(session.get("user_id") or "")
+
+
+def csrf_token():
+    """Returns the CSRF token for the forms of the current page."""
+    if "csrf_token" not in g:
+        timestamp = str(int(time.time()))
+        g.csrf_token = f"{timestamp}.{_signature(_binding(), timestamp)}"
+    return g.csrf_token
+
+
+def valid_csrf_token(token):
+    """Returns True if the token was issued to the current user and has not expired."""
+    timestamp, _, signature = (token or "").partition(".")
+    if not timestamp.isdigit() or time.time() - int(timestamp) > config.csrf_token_ttl:
+        return False
+    return hmac.compare_digest(signature, _signature(_binding(), timestamp))
+
+
+def same_origin(required=False):
+    """
+    Returns False if the browser reports that the request came from another
+    site. With required=True the Referer is used when there is no Origin,
+    and a request that reports neither is rejected as well.
+    """
+    origin = request.headers.get("Origin")
+    if not origin and required:
+        origin = request.referrer
+    if not origin:
+        return not required
+    return urlparse(origin).netloc == request.host
+
+
+def check_csrf():
+    """Rejects unsafe requests without a valid CSRF token."""
+    if request.method in SAFE_METHODS:
+        return
+    anonymous = not _binding()
+    if not same_origin(required=anonymous) or not valid_csrf_token(request.form.get("csrf_token")):
+        abort(403)
+
+
+def sessionless(flask_request):
+    """Returns True for the paths that never need a session."""
+    return flask_request.path.startswith(SESSIONLESS_PATHS)
+
+
+class CookieSessionInterface(SecureCookieSessionInterface):
+    """The signed-cookie session, skipped for static files and images."""
+
+    def open_session(self, app, request):  # pylint: disable=redefined-outer-name
+        if sessionless(request):
+            return None
+        return super().open_session(app, request)
+
+
+class ServerSession(SecureCookieSession):
+    """A session whose data is kept in the sessions table under a random id."""
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.loaded_user_id = (initial or {}).get("user_id")
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """Keeps the session data in SQLite; the cookie only holds the session id."""
+
+    def open_session(self, app, request):  # pylint: disable=redefined-outer-name
+        if sessionless(request):
+            return None
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            sql = "SELECT data FROM sessions WHERE id = ? AND expires_at > ?"
+            rows = db.query(sql, [sid, int(time.time())])
+            if rows:
+                return ServerSession(json.loads(rows[0]["data"]), sid)
+        return ServerSession()
+
+    def save_session(self, app, session, response):  # pylint: disable=redefined-outer-name
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session.modified:
+            return
+
+        old_sid = session.sid
+        if not session:
+            if old_sid:
+                db.execute("DELETE FROM sessions WHERE id = ?", [old_sid])
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # A new id whenever the logged-in user changes prevents session fixation.
+        if not old_sid or session.get("user_id") != session.loaded_user_id:
+            session.sid = secrets.token_urlsafe(32)
+            purge_expired_sessions()
+        expires_at = int(time.time() + app.permanent_session_lifetime.total_seconds())
+        with db.transaction():
+            if old_sid and old_sid != session.sid:
+                db.execute("DELETE FROM sessions WHERE id = ?", [old_sid])
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                [session.sid, json.dumps(dict(session)), expires_at]
+            )
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def purge_expired_sessions():
+    """Deletes the expired rows of the server-side session store."""
+    db.execute("DELETE FROM sessions WHERE expires_at <= ?", [int(time.time())])
+
+
+SESSION_INTERFACES = {
+    "cookie": CookieSessionInterface,
+    "sqlite": SQLiteSessionInterface,
+}
+
+
+def init_app(app):
+    """Installs the session interface, the CSRF check and the csrf_token() template global."""
+    app.session_interface = SESSION_INTERFACES[config.session_store]()
+    app.before_request(check_csrf)
+    app.add_template_global(csrf_token)
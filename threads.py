@@ -2,9 +2,18 @@
 Module for handling message threads and messages within threads in the Friend App.
 """
 
-import db
 from datetime import datetime
 
+import cache
+import db
+import events
+import writer
+
+HISTORY_SIZE = 50
+INBOX_PAGE_SIZE = 20
+SNIPPET_LENGTH = 100
+DELETE_CHUNK_SIZE = 1000
+
 def get_threads_by_message(message_id):
     """Return all threads for a specific message."""
     sql = """
@@ -19,6 +28,30 @@ def get_threads_by_message(message_id):
     """
     return db.query(sql, [message_id])
 
+def remove_threads_by_message(message_id, chunk_size=DELETE_CHUNK_SIZE):
+    """
+    Delete one chunk of a message's threads: up to chunk_size messages of
+    one thread, and the thread itself once it is empty. Returns False when
+    the message has no threads left.
+    """
+    rows = db.query("SELECT id FROM threads WHERE ad_id = ? LIMIT 1", [message_id])
+    if not rows:
+        return False
+    thread_id = rows[0][0]
+    with db.transaction():
+        sql = "SELECT id FROM thread_messages WHERE thread_id = ? ORDER BY id LIMIT 1 OFFSET ?"
+        last = db.query(sql, [thread_id, chunk_size - 1])
+        if last:
+            sql = "DELETE FROM thread_messages WHERE thread_id = ? AND id <= ?"
+            db.execute(sql, [thread_id, last[0][0]])
+        else:
+            db.execute("DELETE FROM thread_messages WHERE thread_id = ?", [thread_id])
+            db.execute("DELETE FROM thread_participants WHERE thread_id = ?", [thread_id])
+            db.execute("DELETE FROM threads WHERE id = ?", [thread_id])
+    cache.invalidate("threads", thread_id)
+    return True
+
+@cache.cached("threads")
 def get_thread(thread_id):
     """Return a single thread by ID."""
     sql = """
@@ -29,79 +62,155 @@ def get_thread(thread_id):
     result = db.query(sql, [thread_id])
     return result[0] if result else None
 
-def get_user_threads(user_id):
-    """Return all threads for a specific user."""
+def get_user_threads(user_id, before=None, limit=INBOX_PAGE_SIZE):
+    """
+    Return one page of the user's inbox, most recently active thread first.
+
+    Rows come from the user's thread_participants rows, which carry the
+    partner name, ad title, last message and last activity time, so the page
+    is a single range scan of the inbox index. before is the (last_activity,
+    thread id) cursor of the previous page; the result holds the rows and
+    the "older" cursor, which is None on the last page.
+    """
     sql = """
-    SELECT t.id, t.ad_id,
-           CASE
-               WHEN t.user1_id = ? THEN u2.username
-               ELSE u1.username
-           END AS partner,
-           m.title AS ad_title
-    FROM threads t
-    JOIN users u1 ON t.user1_id = u1.id
-    JOIN users u2 ON t.user2_id = u2.id
-    JOIN messages m ON t.ad_id = m.id
-    WHERE t.user1_id = ? OR t.user2_id = ?
-    ORDER BY t.id DESC
+    SELECT thread_id AS id, partner_name AS partner, ad_title, last_message,
+           last_activity, unread_count
+    FROM thread_participants
+    WHERE user_id = ?
     """
-    return db.query(sql, [user_id, user_id, user_id])
+    params = [user_id]
+    if before is not None:
+        sql += "AND (last_activity, thread_id) < (?, ?) "
+        params += before
+    sql += "ORDER BY last_activity DESC, thread_id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = db.query(sql, params)
+    older = rows[limit - 1] if len(rows) > limit else None
+    return {
+        "threads": rows[:limit],
+        "older": (older["last_activity"], older["id"]) if older else None,
+    }
 
-def get_messages(thread_id, user_id):
-    """Return messages in a thread for a user."""
+def get_messages(thread_id, before_id=None, after_id=None, limit=HISTORY_SIZE):
+    """
+    Return a page of messages in a thread, oldest first.
+
+    By default the newest messages are returned; before_id gives the page
+    before that message and after_id only the messages newer than it. Pages
+    are keyed on the monotonic message id. The result holds the rows and the
+    "earlier" cursor, which is None when there is nothing older to load.
+    """
     sql = """
     SELECT m.id, m.thread_id, m.sender_id, u.username AS sender_name, m.content, m.created_at
     FROM thread_messages m
     JOIN users u ON m.sender_id = u.id
     WHERE m.thread_id = ?
-    ORDER BY m.created_at ASC
     """
-    return db.query(sql, [thread_id])
+    if after_id is not None:
+        rows = db.query(
+            sql + "AND m.id > ? ORDER BY m.id ASC LIMIT ?", [thread_id, after_id, limit]
+        )
+        return {"messages": rows, "earlier": None}
+
+    if before_id is not None:
+        rows = db.query(
+            sql + "AND m.id < ? ORDER BY m.id DESC LIMIT ?", [thread_id, before_id, limit + 1]
+        )
+    else:
+        rows = db.query(sql + "ORDER BY m.id DESC LIMIT ?", [thread_id, limit + 1])
+    has_earlier = len(rows) > limit
+    rows = rows[:limit][::-1]
+    return {"messages": rows, "earlier": rows[0]["id"] if has_earlier else None}
 
-def mark_thread_as_read(thread_id, user_id):
-    """Mark all messages in a thread as read for the given user."""
+def mark_thread_as_read(thread_id, user_id, last_id):
+    """
+    Mark the messages of a thread up to last_id, the newest one shown to the
+    user, as read. Messages that arrived after it stay unread. Only the
+    user's read-state row is touched, and only if it has unread messages.
+    The update is queued to the group-commit writer without waiting for it.
+    """
     sql = """
-    UPDATE thread_messages
-    SET read_by_user = 1
-    WHERE thread_id = ? AND sender_id != ?
+    UPDATE thread_participants
+    SET last_read_id = ?,
+        unread_count = (SELECT COUNT(*) FROM thread_messages
+                        WHERE thread_id = ? AND id > ? AND sender_id != ?)
+    WHERE thread_id = ? AND user_id = ? AND unread_count > 0 AND last_read_id < ?
     """
-    db.execute(sql, [thread_id, user_id])
+    params = [last_id, thread_id, last_id, user_id, thread_id, user_id, last_id]
+    writer.submit(db.execute, sql, params)
 
 def get_or_create_thread(message_id, user_id, owner_id):
     """
-    Return an existing thread ID for a message between two users,
-    or create a new one if it does not exist.
-    """
-    sql = """
-    SELECT id FROM threads
-    WHERE ad_id = ? AND 
-          ((user1_id = ? AND user2_id = ?) OR (user1_id = ? AND user2_id = ?))
+    Return the thread of a message between two users, creating it if it
+    does not exist. The insert and the uniqueness check on the canonical
+    (ad_id, user_low, user_high) key are one atomic statement, so
+    concurrent starts of the same conversation all get the same thread.
     """
-    result = db.query(sql, [message_id, user_id, owner_id, owner_id, user_id])
-    if result:
-        return result[0][0]
+    with db.transaction():
+        sql = """
+        INSERT INTO threads (user1_id, user2_id, ad_id) VALUES (?, ?, ?)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+        """
+        created = db.query(sql, [user_id, owner_id, message_id])
+        if not created:
+            sql = "SELECT id FROM threads WHERE ad_id = ? AND user_low = ? AND user_high = ?"
+            low, high = sorted([user_id, owner_id])
+            return db.query(sql, [message_id, low, high])[0][0]
 
-    sql = "INSERT INTO threads (user1_id, user2_id, ad_id) VALUES (?, ?, ?)"
-    thread_id = db.execute(sql, [user_id, owner_id, message_id])
+        thread_id = created[0][0]
+        now = datetime.utcnow()
+        sql = "SELECT id, username FROM users WHERE id IN (?, ?)"
+        names = dict(db.query(sql, [user_id, owner_id]))
+        ad_title = db.query("SELECT title FROM messages WHERE id = ?", [message_id])[0][0]
+        sql = """
+        INSERT INTO thread_participants (thread_id, user_id, partner_name, ad_title, last_activity)
+        VALUES (?, ?, ?, ?, ?)
+        """
+        db.execute_many(sql, [
+            (thread_id, user_id, names[owner_id], ad_title, now),
+            (thread_id, owner_id, names[user_id], ad_title, now),
+        ])
     return thread_id
 
 def send_message(thread_id, sender_id, content):
-    """Send a message in a thread."""
-    sql = """
-    INSERT INTO thread_messages (thread_id, sender_id, content, created_at, read_by_user)
-    VALUES (?, ?, ?, ?, 0)
     """
-    db.execute(sql, [thread_id, sender_id, content, datetime.utcnow()])
+    Send a message in a thread. The other participant's unread count goes
+    up by one and the sender's own read position moves to the new message.
+    The write is group-committed with other writes; this returns the new
+    message id once it has been committed.
+    """
+    message_id = writer.run(_insert_message, thread_id, sender_id, content, datetime.utcnow())
+    events.publish(int(thread_id), message_id)
+    return message_id
+
+def _insert_message(thread_id, sender_id, content, created_at):
+    with db.transaction():
+        sql = """
+        INSERT INTO thread_messages (thread_id, sender_id, content, created_at, read_by_user)
+        VALUES (?, ?, ?, ?, 0)
+        """
+        message_id = db.execute(sql, [thread_id, sender_id, content, created_at])
+
+        sql = """
+        UPDATE thread_participants
+        SET unread_count = unread_count + (user_id != ?),
+            last_read_id = CASE WHEN user_id = ? THEN ? ELSE last_read_id END,
+            last_message = ?,
+            last_activity = ?
+        WHERE thread_id = ?
+        """
+        db.execute(sql, [sender_id, sender_id, message_id, content[:SNIPPET_LENGTH],
+                         created_at, thread_id])
+    return message_id
 
 def get_unread_messages(user_id):
-    """Return all unread messages for a specific user."""
+    """Return the user's threads that have unread messages, with the counts."""
     sql = """
-    SELECT tm.thread_id, tm.sender_id, u.username AS sender_name
-    FROM thread_messages tm
-    JOIN users u ON tm.sender_id = u.id
-    WHERE tm.sender_id != ? AND tm.read_by_user = 0
-    ORDER BY tm.created_at DESC
+    SELECT thread_id, unread_count, partner_name AS sender_name
+    FROM thread_participants
+    WHERE user_id = ? AND unread_count > 0
+    ORDER BY thread_id DESC
     """
     return db.query(sql, [user_id])
-
-
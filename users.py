@@ -2,23 +2,43 @@
 Module for handling user data and user profiles in the Friend App.
 """
 
+import cache
 import db
-from werkzeug.security import generate_password_hash, check_password_hash
+import images
+import jobs
+import passwords
 
 
+@cache.cached("users")
 def get_user(user_id):
     """Return a single user by ID."""
-    sql = "SELECT id, username, age, bio FROM users WHERE id = ?"
+    sql = "SELECT id, username, age, bio, image_hash FROM users WHERE id = ?"
     result = db.query(sql, [user_id])
     return result[0] if result else None
 
 
+def get_users(user_ids):
+    """
+    Return {user id: row} for the given users with one query. Rows already
+    in the read cache are not fetched again.
+    """
+    found = cache.get_many("users", user_ids)
+    missing = [user_id for user_id in set(user_ids) if user_id not in found]
+    if missing:
+        sql = "SELECT id, username, age, bio, image_hash FROM users WHERE id IN ({})"
+        rows = db.query(sql.format(", ".join("?" * len(missing))), missing)
+        fetched = {row["id"]: row for row in rows}
+        cache.set_many("users", fetched)
+        found.update(fetched)
+    return found
+
+
 def get_messages(user_id):
     """Return all messages created by a specific user."""
     sql = """
     SELECT m.id, m.title, m.description
     FROM messages m
-    WHERE m.user_id = ?
+    WHERE m.user_id = ? AND m.deleted = 0
     ORDER BY m.id DESC
     """
     return db.query(sql, [user_id])
@@ -26,18 +46,23 @@ def get_messages(user_id):
 
 def create_user(username, password, age, bio):
     """Create a new user with a hashed password."""
-    password_hash = generate_password_hash(password)
+    password_hash = passwords.hash_password(password)
     sql = "INSERT INTO users (username, password_hash, age, bio) VALUES (?, ?, ?, ?)"
     return db.execute(sql, [username, password_hash, age, bio])
 
 
 def check_login(username, password):
-    """Check user login credentials and return user ID if valid."""
+    """
+    Check user login credentials and return user ID if valid. Hashes made
+    with an outdated method are replaced in the background.
+    """
     sql = "SELECT id, password_hash FROM users WHERE username = ?"
     result = db.query(sql, [username])
     if result:
         user_id, password_hash = result[0]
-        if check_password_hash(password_hash, password):
+        if passwords.verify_password(password_hash, password):
+            if passwords.needs_rehash(password_hash):
+                passwords.rehash_later(user_id, password)
             return user_id
     return None
 
@@ -46,17 +71,21 @@ def update_profile(user_id, age, bio):
     """Update user's age and bio."""
     sql = "UPDATE users SET age = ?, bio = ? WHERE id = ?"
     db.execute(sql, [age, bio, user_id])
+    cache.invalidate("users", user_id)
+    cache.clear("messages")
 
 
 def update_image(user_id, image_data):
-    """Update user's profile image."""
-    sql = "UPDATE users SET image = ? WHERE id = ?"
-    db.execute(sql, [image_data, user_id])
-
-
-def get_image(user_id):
-    """Return user's profile image."""
-    sql = "SELECT image FROM users WHERE id = ?"
-    result = db.query(sql, [user_id])
-    return result[0][0] if result and result[0][0] else None
-
+    """
+    Store a new profile image, point the user at it and queue the job that
+    makes its thumbnails. Returns the hash of the image, or None if the data
+    is not a supported image.
+    """
+    image_hash = images.save_upload(image_data)
+    if image_hash is None:
+        return None
+    sql = "UPDATE users SET image_hash = ? WHERE id = ?"
+    db.execute(sql, [image_hash, user_id])
+    cache.invalidate("users", user_id)
+    jobs.enqueue("image_variants", image_hash, key=f"image_variants:{image_hash}")
+    return image_hash
@@ -0,0 +1,143 @@
+"""
+Group commit for high-rate writes such as chat messages and read markers.
+
+Writes are queued to a single writer thread, which collects them for at most
+WRITE_BATCH_MS milliseconds or WRITE_BATCH_SIZE operations and runs the whole
+batch in one BEGIN IMMEDIATE transaction with one commit. Every operation runs
+inside its own savepoint, so a failing operation only rolls back itself.
+
+submit() returns a concurrent.futures.Future that is resolved after the batch
+has been committed; asyncio code can await it with asyncio.wrap_future. run()
+waits for the commit, so the caller reads its own write on the next query.
+WRITE_SYNCHRONOUS sets PRAGMA synchronous of the writer connection; FULL makes
+every commit durable against power loss at the cost of one fsync per batch.
+"""
+
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import config
+import db
+import metrics
+
+RESULT_TIMEOUT = 30
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+_STOP = object()
+
+
+class Writer:
+    """A queue of write operations flushed by one thread in batched transactions."""
+
+    def __init__(self, batch_ms, batch_size, synchronous="NORMAL"):
+        if synchronous not in SYNCHRONOUS_MODES:
+            raise ValueError(f"unknown synchronous mode: {synchronous}")
+        self.batch_ms = batch_ms
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args) to be run on the writer connection and returns a
+        Future of its result. The function may use db.execute and
+        db.transaction as usual; they join the batch transaction.
+        """
+        future = Future()
+        self._start()
+        self._queue.put((func, args, future))
+        return future
+
+    def stop(self):
+        """Flushes the queued operations and stops the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        db.open_thread_connection()
+        db.get_connection().execute(f"PRAGMA synchronous = {self.synchronous}")
+        try:
+            while True:
+                batch, stop = self._collect()
+                if batch:
+                    self._flush(batch)
+                if stop:
+                    return
+        finally:
+            db.close_connection()
+
+    def _collect(self):
+        """Waits for the next operation and gathers the rest of its batch."""
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.batch_ms / 1000
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else \
+                    self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _flush(self, batch):
+        """Runs a batch in one transaction and resolves the futures after the commit."""
+        outcomes = []
+        try:
+            with db.transaction() as con:
+                for func, args, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    con.execute("SAVEPOINT write_op")
+                    try:
+                        outcome = (future, func(*args), None)
+                    except Exception as error:  # pylint: disable=broad-exception-caught
+                        con.execute("ROLLBACK TO write_op")
+                        outcome = (future, None, error)
+                    con.execute("RELEASE write_op")
+                    outcomes.append(outcome)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        metrics.WRITE_BATCH_SIZE.observe(len(outcomes))
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+_writer = Writer(config.write_batch_ms, config.write_batch_size, config.write_synchronous)
+atexit.register(_writer.stop)
+
+
+def submit(func, *args):
+    """Queues a write operation without waiting for it; returns its Future."""
+    return _writer.submit(func, *args)
+
+
+def run(func, *args):
+    """Queues a write operation and returns its result once it is committed."""
+    return _writer.submit(func, *args).result(timeout=RESULT_TIMEOUT)